@@ -0,0 +1,109 @@
+# Dumps game files of any supported format to txt, telling them apart by their first bytes.
+# Usage: python dump.py <file or directory> [...] [-o output directory] [-r] [-j jobs] [--region us|all] [--language en|ja]
+
+import argparse
+import concurrent.futures
+import glob
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import formats
+
+
+def dump_file(name: str, src: str, dst: str, **options) -> list[str]:
+    """Dump one file of a format to dst (a directory for MSG.DAT), importing only that format's dumper.
+
+    Returns the paths written."""
+    module = formats.load(name)
+    match name:
+        case 'btxt':
+            module.unpack(src, dst)
+        case 'conquest':
+            table = module.tables(options.get('language', 'en'))[os.path.splitext(os.path.basename(src))[0]]
+            table.dump_file(src, dst)
+        case 'gmsg':
+            module.dump(src, dst)
+        case 'msgdat':
+            os.makedirs(dst, exist_ok=True)
+            module.dump(src, dst)
+        case 'ntxl':
+            module.dump(src, dst)
+        case 'trozei':
+            region = options.get('region', 'us')
+            return module.dump_regions(src, dst, module.REGIONS if region == 'all' else [region])
+    return [dst]
+
+
+def iter_files(path: str, recursive: bool = False):
+    if not os.path.isdir(path):
+        yield path
+        return
+    for src in sorted(glob.glob(os.path.join(path, '**', '*') if recursive else os.path.join(path, '*'), recursive=recursive)):
+        if os.path.isfile(src):
+            yield src
+
+
+def output_path(name: str, src: str, dst: str, root: str | None = None) -> str:
+    # A file keeps its path relative to the directory it was found in, plus .txt, so that two
+    # files of different formats sharing a name don't collide. A MSG.DAT's blocks go in a
+    # directory named after it without its extension.
+    path = os.path.join(dst, os.path.basename(src) if root is None else os.path.relpath(src, root))
+    return os.path.splitext(path)[0] if name == 'msgdat' else path + '.txt'
+
+
+def dump(paths: list[str], dst: str | None = None, *, recursive: bool = False, jobs: int = 0, **options) -> int:
+    """Dump every file of a known format under the given paths across a process pool.
+
+    Files given by name must be of a known format; ones found in a directory are skipped if
+    not. Output goes next to each file unless dst is given. Returns the number of files that failed."""
+    failed = 0
+    tasks = []
+    for path in paths:
+        root = path if os.path.isdir(path) else None
+        for src in iter_files(path, recursive):
+            try:
+                name = formats.sniff(src)
+            except OSError as e:
+                failed += 1
+                print(f'{src}: {type(e).__name__}: {e}', file=sys.stderr)
+                continue
+            if name is None:
+                if root is None:
+                    failed += 1
+                    print(f'{src}: not a file of a known format', file=sys.stderr)
+                continue
+            if dst is None:
+                dst_fn = output_path(name, src, os.path.dirname(src))
+            else:
+                dst_fn = output_path(name, src, dst, root)
+                os.makedirs(os.path.dirname(dst_fn), exist_ok=True)
+            tasks.append((name, src, dst_fn))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs or None) as executor:
+        futures = {executor.submit(dump_file, name, src, dst_fn, **options): src for name, src, dst_fn in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                written = future.result()
+            except Exception as e:
+                failed += 1
+                print(f'{futures[future]}: {type(e).__name__}: {e}', file=sys.stderr)
+                continue
+            print(*written, sep='\n')
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Dumps game files of any supported format to txt files, '
+                                                 'detecting the format of each one')
+    parser.add_argument('paths', nargs='+', help='files or directories; unknown files in a directory are skipped')
+    parser.add_argument('-o', '--output', help='output directory (defaults to next to each file)')
+    parser.add_argument('-r', '--recursive', help='also dump files in subdirectories', action='store_true')
+    parser.add_argument('-j', '--jobs', help='number of files to dump in parallel (0 for one per CPU)', type=int, default=0)
+    parser.add_argument('--region', help='trozei region table (all dumps every one)',
+                        choices=[*formats.REGIONS, 'all'], default='us')
+    parser.add_argument('--language', help='conquest record layout', choices=formats.LANGUAGES, default='en')
+    args = parser.parse_args()
+
+    if dump(args.paths, args.output, recursive=args.recursive, jobs=args.jobs, region=args.region, language=args.language):
+        sys.exit(1)
@@ -0,0 +1,173 @@
+# Writes dumped rows to an indexed SQLite database, or to a Parquet file whose string
+# columns are dictionary-encoded, so they can be queried without re-parsing txt dumps.
+
+import concurrent.futures
+import contextlib
+import itertools
+import os
+import sqlite3
+import sys
+from typing import Callable, Iterable
+
+BATCH_SIZE = 50000
+SQLITE_EXTENSIONS = ('.sqlite', '.sqlite3', '.db')
+COLUMNAR_EXTENSIONS = ('.parquet',)
+SQL_TYPES = {int: 'INTEGER', str: 'TEXT'}
+
+
+def is_export(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in SQLITE_EXTENSIONS + COLUMNAR_EXTENSIONS
+
+
+def quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def batches(rows: Iterable, size: int = BATCH_SIZE):
+    rows = iter(rows)
+    while batch := list(itertools.islice(rows, size)):
+        yield batch
+
+
+class Exporter:
+    """Writes tables of rows to `path`, as SQLite or Parquet depending on its extension.
+
+    Columns are (name, type) pairs, the type being int or str. Rows from a source file
+    carry its name in an extra first "file" column; writing a file again replaces its rows.
+    A Parquet file holds a single table."""
+
+    def __init__(self, path: str):
+        self.path = path
+        ext = os.path.splitext(path)[1].lower()
+        if ext in SQLITE_EXTENSIONS:
+            self.db = sqlite3.connect(path)
+        elif ext in COLUMNAR_EXTENSIONS:
+            # imported here, since it takes longer than everything else a dumper loads
+            try:
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError(f'pyarrow is needed to export to {ext} files') from None
+            self.db = None
+            self.writer = None
+            self.table = None
+        else:
+            raise ValueError(f'cannot export to {ext or "files without an extension"}; '
+                             f'use one of {", ".join(SQLITE_EXTENSIONS + COLUMNAR_EXTENSIONS)}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+        elif self.writer is not None:
+            self.writer.close()
+
+    def write(self, table: str, columns: list[tuple[str, type]], rows: Iterable, *, file: str | None = None,
+              index: Iterable[str] = ()):
+        """Write rows to a table, indexing the named columns (and the file, if given).
+
+        Without a file, the table is replaced as a whole."""
+        if file is not None:
+            columns = [('file', str)] + columns
+            rows = ((file, *row) for row in rows)
+            index = ['file', *index]
+        if self.db is not None:
+            self.write_sqlite(table, columns, rows, file, index)
+        else:
+            self.write_parquet(table, columns, rows)
+
+    def write_sqlite(self, table, columns, rows, file, index):
+        # One transaction per call, with the rows inserted in batches; indexes are created
+        # after the first load, which is cheaper than maintaining them row by row.
+        names = ', '.join(quote(name) + ' ' + SQL_TYPES[kind] for name, kind in columns)
+        with self.db:
+            if file is None:
+                self.db.execute(f'DROP TABLE IF EXISTS {quote(table)}')
+            self.db.execute(f'CREATE TABLE IF NOT EXISTS {quote(table)} ({names})')
+            if file is not None:
+                self.db.execute(f'DELETE FROM {quote(table)} WHERE file = ?', (file,))
+            insert = f'INSERT INTO {quote(table)} VALUES ({", ".join("?" * len(columns))})'
+            for batch in batches(rows):
+                self.db.executemany(insert, batch)
+            for name in index:
+                self.db.execute(f'CREATE INDEX IF NOT EXISTS {quote(table + "_" + name)} ON {quote(table)} ({quote(name)})')
+
+    def write_parquet(self, table, columns, rows):
+        import pyarrow.parquet  # already loaded by __init__
+        if self.writer is None:
+            self.table = table
+            schema = pyarrow.schema([(name, pyarrow.int64() if kind is int else pyarrow.string())
+                                     for name, kind in columns])
+            self.writer = pyarrow.parquet.ParquetWriter(self.path, schema, use_dictionary=True)
+        elif table != self.table:
+            raise ValueError(f'{self.path} already holds the {self.table} table')
+        for batch in batches(rows):
+            self.writer.write_batch(pyarrow.RecordBatch.from_arrays(
+                [pyarrow.array(values, self.writer.schema.field(i).type) for i, values in enumerate(zip(*batch))],
+                schema=self.writer.schema))
+
+
+def read_all(read_rows: Callable[[str], list], sources: list[str], *, jobs: int = 1):
+    """Call read_rows on each source, yielding (src, rows, exception) as each file finishes."""
+    if jobs == 1:
+        for src in sources:
+            try:
+                yield src, read_rows(src), None
+            except Exception as e:
+                yield src, None, e
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs or None) as executor:
+        futures = {executor.submit(read_rows, src): src for src in sources}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
+
+
+def open_exporter(path: str | None):
+    """An Exporter for path, or a context giving None when there is nothing to export."""
+    return Exporter(path) if path else contextlib.nullcontext()
+
+
+def write_file(exporter: Exporter, table: str, columns: list[tuple[str, type]], src: str, rows: Iterable, *,
+               index: Iterable[str] = ()) -> int:
+    """Write the rows of one source file, reporting it if they could not be written.
+
+    For dumpers that already hold a file's rows, so it need not be read again.
+    Returns the number of files that failed, 0 or 1."""
+    try:
+        exporter.write(table, columns, rows, file=src, index=index)
+    except Exception as e:
+        print(f'{src}: {type(e).__name__}: {e}', file=sys.stderr)
+        return 1
+    return 0
+
+
+def write_files(exporter: Exporter, table: str, columns: list[tuple[str, type]], read_rows: Callable[[str], list],
+                sources: Iterable[str], *, index: Iterable[str] = (), jobs: int = 1) -> int:
+    """Write the rows read_rows(src) returns for each source file into one table.
+
+    Files are read across a process pool unless jobs is 1, and written in one process as
+    they finish. Returns the number of files that failed."""
+    failed = 0
+    for src, rows, error in read_all(read_rows, list(sources), jobs=jobs):
+        if error is not None:
+            failed += 1
+            print(f'{src}: {type(error).__name__}: {error}', file=sys.stderr)
+            continue
+        failed += write_file(exporter, table, columns, src, rows, index=index)
+    return failed
+
+
+def export_files(path: str, table: str, columns: list[tuple[str, type]], read_rows: Callable[[str], list],
+                 sources: Iterable[str], *, index: Iterable[str] = (), jobs: int = 1) -> int:
+    """Export the rows read_rows(src) returns for each source file into one table at path
+    (see write_files). Returns the number of files that failed."""
+    with Exporter(path) as exporter:
+        return write_files(exporter, table, columns, read_rows, sources, index=index, jobs=jobs)
@@ -0,0 +1,116 @@
+# The dumpers by format, for tools that work across games. They are loaded from their
+# file paths: the game directories aren't packages, and typing/ would shadow the
+# standard library module of the same name.
+
+import functools
+import importlib.util
+import os
+import struct
+import sys
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+FORMATS = {
+    'btxt': 'touzoku/btxt.py',
+    'conquest': 'conquest/conquest.py',
+    'gmsg': 'typing/gmsg.py',
+    'msgdat': 'conquest/msgdat.py',
+    'ntxl': 'pokken/ntxl.py',
+    'trozei': 'trozei/trozei.py',
+}
+
+# the files a format reads when given a directory; any other format reads every file
+PATTERNS = {
+    'btxt': '*.btxt',
+    'conquest': '*.dat',
+    'msgdat': 'MSG.DAT',
+    'ntxl': '*.ntxl',
+}
+
+# the choices of the options trozei and conquest take, so they can be checked without loading
+# those dumpers; they must match trozei.REGIONS and conquest.LANGUAGES
+REGIONS = ['jp', 'us', 'eu', 'kr']
+LANGUAGES = ['en', 'ja']
+
+
+@functools.cache
+def load(name: str):
+    """Import a format's dumper by name, only the first time it is needed."""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, FORMATS[name]))
+    module = importlib.util.module_from_spec(spec)
+    # registered before running it, so that process pools can pickle its functions
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return module
+
+
+def read_rows(name: str, path: str, **options) -> list[tuple]:
+    """Rows of a file as the format exports them (see common.export), its text being the last column."""
+    return load(name).export_rows(path, **options)
+
+
+def is_trozei(head: bytes) -> bool:
+    # 'MSG', a language byte and FE FF 00 01, then the message table at 0x10
+    return head[:3] == b'MSG' and head[4:8] == b'\xFE\xFF\x00\x01' and head[0x10:0x14] == b'MTBL'
+
+
+def is_btxt(f, size: int) -> bool:
+    # A zero, its magic and two equal string counts, then for each string an 8-byte metadata
+    # entry starting with a 1, and its label and text offsets, ascending and inside the file.
+    # An empty BTXT can't be told from zero padding, so it isn't recognized.
+    f.seek(0)
+    head = f.read(12)
+    if len(head) < 12:
+        return False
+    h_00, _, count, count2 = struct.unpack('<IIHH', head)
+    pools = 12 + 16 * count
+    if h_00 != 0 or count != count2 or count == 0 or size < pools:
+        return False
+    tables = f.read(16 * count)
+    if any(first != 1 for first, in struct.iter_unpack('<I4x', tables[:8 * count])):
+        return False
+    offsets = struct.unpack_from(f'<{2 * count}I', tables, 8 * count)
+    return all(a <= b for a, b in zip(offsets, offsets[1:])) and offsets[-1] < size - pools
+
+
+def is_msgdat(f, size: int) -> bool:
+    # (start, length) pairs for each block, ending in a zero pair before the first block
+    f.seek(0)
+    head = f.read(8)
+    if len(head) < 8:
+        return False
+    start = struct.unpack_from('<I', head)[0]
+    f.seek(0)
+    table = f.read(min(start, 0x10000))
+    pairs = list(struct.iter_unpack('<II', table[:len(table) & ~7]))
+    if (0, 0) not in pairs:
+        return False
+    pairs = pairs[:pairs.index((0, 0))]
+    return bool(pairs) and all(8 * (len(pairs) + 1) <= start and start + length <= size for start, length in pairs)
+
+
+def sniff(path: str) -> str | None:
+    """Guess a file's format from its first bytes (and, for Conquest tables, its name) without
+    importing any dumper but Conquest's. Returns None for anything else."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(0x20)
+        if head.startswith(b'GMSG'):
+            return 'gmsg'
+        if head.startswith(b'NTXL\x05\x01'):
+            return 'ntxl'
+        if is_trozei(head):
+            return 'trozei'
+        name, ext = os.path.splitext(os.path.basename(path))
+        if ext == '.dat' and name in load('conquest').tables():
+            return 'conquest'
+        if is_btxt(f, size):
+            return 'btxt'
+        if is_msgdat(f, size):
+            return 'msgdat'
+    return None
+
@@ -0,0 +1,194 @@
+# Converts halfwidth katakana to fullwidth katakana or hiragana in one pass.
+# Usage: python kana.py [--katakana] <input file> <output file>
+
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.substitution import Substitution
+
+
+KATAKANA = {
+	'ｶﾞ': 'ガ',
+	'ｷﾞ': 'ギ',
+	'ｸﾞ': 'グ',
+	'ｹﾞ': 'ゲ',
+	'ｺﾞ': 'ゴ',
+	'ｻﾞ': 'ザ',
+	'ｼﾞ': 'ジ',
+	'ｽﾞ': 'ズ',
+	'ｾﾞ': 'ゼ',
+	'ｿﾞ': 'ゾ',
+	'ﾀﾞ': 'ダ',
+	'ﾁﾞ': 'ヂ',
+	'ﾂﾞ': 'ヅ',
+	'ﾃﾞ': 'デ',
+	'ﾄﾞ': 'ド',
+	'ﾊﾞ': 'バ',
+	'ﾋﾞ': 'ビ',
+	'ﾌﾞ': 'ブ',
+	'ﾍﾞ': 'ベ',
+	'ﾎﾞ': 'ボ',
+	'ﾊﾟ': 'パ',
+	'ﾋﾟ': 'ピ',
+	'ﾌﾟ': 'プ',
+	'ﾍﾟ': 'ペ',
+	'ﾎﾟ': 'ポ',
+	'ｳﾞ': 'ヴ',
+	'ｱ': 'ア',
+	'ｲ': 'イ',
+	'ｳ': 'ウ',
+	'ｴ': 'エ',
+	'ｵ': 'オ',
+	'ｶ': 'カ',
+	'ｷ': 'キ',
+	'ｸ': 'ク',
+	'ｹ': 'ケ',
+	'ｺ': 'コ',
+	'ｻ': 'サ',
+	'ｼ': 'シ',
+	'ｽ': 'ス',
+	'ｾ': 'セ',
+	'ｿ': 'ソ',
+	'ﾀ': 'タ',
+	'ﾁ': 'チ',
+	'ﾂ': 'ツ',
+	'ﾃ': 'テ',
+	'ﾄ': 'ト',
+	'ﾅ': 'ナ',
+	'ﾆ': 'ニ',
+	'ﾇ': 'ヌ',
+	'ﾈ': 'ネ',
+	'ﾉ': 'ノ',
+	'ﾊ': 'ハ',
+	'ﾋ': 'ヒ',
+	'ﾌ': 'フ',
+	'ﾍ': 'ヘ',
+	'ﾎ': 'ホ',
+	'ﾏ': 'マ',
+	'ﾐ': 'ミ',
+	'ﾑ': 'ム',
+	'ﾒ': 'メ',
+	'ﾓ': 'モ',
+	'ﾔ': 'ヤ',
+	'ﾕ': 'ユ',
+	'ﾖ': 'ヨ',
+	'ﾗ': 'ラ',
+	'ﾘ': 'リ',
+	'ﾙ': 'ル',
+	'ﾚ': 'レ',
+	'ﾛ': 'ロ',
+	'ﾜ': 'ワ',
+	'ｦ': 'ヲ',
+	'ﾝ': 'ン',
+	'ｧ': 'ァ',
+	'ｨ': 'ィ',
+	'ｩ': 'ゥ',
+	'ｪ': 'ェ',
+	'ｫ': 'ォ',
+	'ｬ': 'ャ',
+	'ｭ': 'ュ',
+	'ｮ': 'ョ',
+	'ｯ': 'ッ'
+}
+
+HIRAGANA = {
+	'ｶﾞ': 'が',
+	'ｷﾞ': 'ぎ',
+	'ｸﾞ': 'ぐ',
+	'ｹﾞ': 'げ',
+	'ｺﾞ': 'ご',
+	'ｻﾞ': 'ざ',
+	'ｼﾞ': 'じ',
+	'ｽﾞ': 'ず',
+	'ｾﾞ': 'ぜ',
+	'ｿﾞ': 'ぞ',
+	'ﾀﾞ': 'だ',
+	'ﾁﾞ': 'ぢ',
+	'ﾂﾞ': 'づ',
+	'ﾃﾞ': 'で',
+	'ﾄﾞ': 'ど',
+	'ﾊﾞ': 'ば',
+	'ﾋﾞ': 'び',
+	'ﾌﾞ': 'ぶ',
+	'ﾍﾞ': 'べ',
+	'ﾎﾞ': 'ぼ',
+	'ﾊﾟ': 'ぱ',
+	'ﾋﾟ': 'ぴ',
+	'ﾌﾟ': 'ぷ',
+	'ﾍﾟ': 'ぺ',
+	'ﾎﾟ': 'ぽ',
+	'ｳﾞ': 'ゔ',
+	'ｱ': 'あ',
+	'ｲ': 'い',
+	'ｳ': 'う',
+	'ｴ': 'え',
+	'ｵ': 'お',
+	'ｶ': 'か',
+	'ｷ': 'き',
+	'ｸ': 'く',
+	'ｹ': 'け',
+	'ｺ': 'こ',
+	'ｻ': 'さ',
+	'ｼ': 'し',
+	'ｽ': 'す',
+	'ｾ': 'せ',
+	'ｿ': 'そ',
+	'ﾀ': 'た',
+	'ﾁ': 'ち',
+	'ﾂ': 'つ',
+	'ﾃ': 'て',
+	'ﾄ': 'と',
+	'ﾅ': 'な',
+	'ﾆ': 'に',
+	'ﾇ': 'ぬ',
+	'ﾈ': 'ね',
+	'ﾉ': 'の',
+	'ﾊ': 'は',
+	'ﾋ': 'ひ',
+	'ﾌ': 'ふ',
+	'ﾍ': 'へ',
+	'ﾎ': 'ほ',
+	'ﾏ': 'ま',
+	'ﾐ': 'み',
+	'ﾑ': 'む',
+	'ﾒ': 'め',
+	'ﾓ': 'も',
+	'ﾔ': 'や',
+	'ﾕ': 'ゆ',
+	'ﾖ': 'よ',
+	'ﾗ': 'ら',
+	'ﾘ': 'り',
+	'ﾙ': 'る',
+	'ﾚ': 'れ',
+	'ﾛ': 'ろ',
+	'ﾜ': 'わ',
+	'ｦ': 'を',
+	'ﾝ': 'ん',
+	'ｧ': 'ぁ',
+	'ｨ': 'ぃ',
+	'ｩ': 'ぅ',
+	'ｪ': 'ぇ',
+	'ｫ': 'ぉ',
+	'ｬ': 'ゃ',
+	'ｭ': 'ゅ',
+	'ｮ': 'ょ',
+	'ｯ': 'っ'
+}
+
+
+to_katakana = Substitution(KATAKANA)
+to_hiragana = Substitution(HIRAGANA)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts halfwidth katakana to fullwidth katakana or hiragana.')
+    parser.add_argument('src', help='Input file')
+    parser.add_argument('dst', help='Output file')
+    parser.add_argument('--katakana', action='store_true', help='Convert to katakana instead of hiragana')
+    parser.add_argument('--encoding', default='utf-8', help='Text encoding of both files')
+    args = parser.parse_args()
+
+    converter = to_katakana if args.katakana else to_hiragana
+    converter.convert_file(args.src, args.dst, args.encoding, args.encoding)
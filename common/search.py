@@ -0,0 +1,224 @@
+# Keeps a full-text index of every string in the dumped files, and searches it.
+# Usage: python search.py <index.sqlite> index <format> <path> [<path> ...] [-r] [-j jobs]
+#        python search.py <index.sqlite> query <text> [-f format] [-n limit]
+
+import argparse
+import functools
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import export, formats
+
+# Strings of three or more characters are found through FTS5's trigram tokenizer. Shorter
+# ones, which trigrams can't match but which are most CJK words, go through a second table
+# holding every distinct one- and two-character substring of each string as a hex token.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    format TEXT NOT NULL,
+    options TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS strings (
+    id INTEGER PRIMARY KEY,
+    file INTEGER NOT NULL REFERENCES files (id),
+    entry TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS strings_file ON strings (file);
+CREATE VIRTUAL TABLE IF NOT EXISTS trigrams USING fts5 (text, content='strings', content_rowid='id', tokenize='trigram');
+CREATE VIRTUAL TABLE IF NOT EXISTS grams USING fts5 (gram, content='', tokenize='ascii');
+'''
+
+
+def grams(text: str) -> str:
+    # fixed-width hex, so no two different substrings share a token
+    codes = [f'{ord(c):06x}' for c in text.lower()]
+    return ' '.join({'x' + code for code in codes} | {'x' + a + b for a, b in zip(codes, codes[1:])})
+
+
+def file_hash(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def iter_files(paths: list[str], pattern: str, recursive: bool = False):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for src in sorted(glob.glob(os.path.join(path, '**', pattern) if recursive else os.path.join(path, pattern),
+                                    recursive=recursive)):
+            if os.path.isfile(src):
+                yield src
+
+
+class Index:
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def update(self, name: str, paths: list[str], *, recursive: bool = False, jobs: int = 1, **options) -> int:
+        """Index the files of one format under the given paths, skipping the ones that haven't changed.
+
+        Files found in a directory are only indexed if they are of that format; files that were
+        indexed under a given directory (or as a given path) but are gone are dropped. Returns the number of files that failed, counting given paths that are missing."""
+        key = json.dumps(options, sort_keys=True)
+        seen = set()
+        pending = {}
+        failed = 0
+        for src in iter_files(paths, formats.PATTERNS.get(name, '*'), recursive):
+            path = os.path.abspath(src)
+            try:
+                stat = os.stat(src)
+            except FileNotFoundError as e:
+                # dropped from the index below; reported when it was named rather than found
+                if src in paths:
+                    failed += 1
+                    print(f'{src}: {type(e).__name__}: {e}', file=sys.stderr)
+                continue
+            if src not in paths and formats.sniff(src) != name:
+                # found in a directory but of another format, so it isn't this format's to index
+                continue
+            seen.add(path)
+            row = self.db.execute('SELECT format, options, mtime_ns, size, sha256 FROM files WHERE path = ?',
+                                  (path,)).fetchone()
+            if row is not None and row[:2] == (name, key) and row[2:4] == (stat.st_mtime_ns, stat.st_size):
+                continue
+            digest = file_hash(src)
+            if row is not None and row[:2] == (name, key) and row[4] == digest:
+                with self.db:
+                    self.db.execute('UPDATE files SET mtime_ns = ?, size = ? WHERE path = ?',
+                                    (stat.st_mtime_ns, stat.st_size, path))
+                continue
+            pending[src] = (path, stat, digest)
+
+        self.prune(name, paths, seen)
+
+        read_rows = functools.partial(formats.read_rows, name, **options)
+        for src, rows, error in export.read_all(read_rows, list(pending), jobs=jobs):
+            if error is not None:
+                failed += 1
+                print(f'{src}: {type(error).__name__}: {error}', file=sys.stderr)
+                continue
+            path, stat, digest = pending[src]
+            self.add(path, name, key, stat, digest, rows)
+            print(src)
+        return failed
+
+    def prune(self, name: str, paths: list[str], seen: set[str]):
+        for path in map(os.path.abspath, paths):
+            prefix = path.rstrip(os.sep) + os.sep
+            rows = self.db.execute('SELECT id, path FROM files WHERE format = ? AND (path = ? OR substr(path, 1, ?) = ?)',
+                                   (name, path, len(prefix), prefix)).fetchall()
+            for file_id, indexed in rows:
+                if indexed not in seen:
+                    with self.db:
+                        self.remove(file_id)
+
+    def add(self, path: str, name: str, key: str, stat: os.stat_result, digest: str, rows: list[tuple]):
+        # A file's rows are replaced in one transaction; the entry is every column but the text
+        with self.db:
+            row = self.db.execute('SELECT id FROM files WHERE path = ?', (path,)).fetchone()
+            if row is not None:
+                self.remove(row[0])
+            file_id = self.db.execute('INSERT INTO files (path, format, options, mtime_ns, size, sha256) '
+                                      'VALUES (?, ?, ?, ?, ?, ?)',
+                                      (path, name, key, stat.st_mtime_ns, stat.st_size, digest)).lastrowid
+            strings = [('\t'.join(map(str, row[:-1])), row[-1]) for row in rows if row[-1] is not None]
+            first = self.db.execute('SELECT coalesce(max(id), 0) + 1 FROM strings').fetchone()[0]
+            ids = range(first, first + len(strings))
+            self.db.executemany('INSERT INTO strings (id, file, entry, text) VALUES (?, ?, ?, ?)',
+                                ((i, file_id, entry, text) for i, (entry, text) in zip(ids, strings)))
+            self.db.executemany('INSERT INTO trigrams (rowid, text) VALUES (?, ?)',
+                                ((i, text) for i, (_, text) in zip(ids, strings)))
+            self.db.executemany('INSERT INTO grams (rowid, gram) VALUES (?, ?)',
+                                ((i, grams(text)) for i, (_, text) in zip(ids, strings)))
+
+    def remove(self, file_id: int):
+        # Both FTS tables are told what each row held, since neither keeps the text itself
+        strings = self.db.execute('SELECT id, text FROM strings WHERE file = ?', (file_id,)).fetchall()
+        self.db.executemany("INSERT INTO trigrams (trigrams, rowid, text) VALUES ('delete', ?, ?)", strings)
+        self.db.executemany("INSERT INTO grams (grams, rowid, gram) VALUES ('delete', ?, ?)",
+                            ((i, grams(text)) for i, text in strings))
+        self.db.execute('DELETE FROM strings WHERE file = ?', (file_id,))
+        self.db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+
+    def search(self, query: str, *, name: str | None = None, limit: int | None = 100) -> list[tuple[str, str, str]]:
+        """(path, entry, text) of the strings containing query, ignoring case, in index order."""
+        if not query:
+            raise ValueError('empty query')
+        if len(query) >= 3:
+            table, match = 'trigrams', '"' + query.replace('"', '""') + '"'
+        else:
+            table, match = 'grams', 'x' + ''.join(f'{ord(c):06x}' for c in query.lower())
+        sql = (f'SELECT files.path, strings.entry, strings.text FROM {table} '
+               f'JOIN strings ON strings.id = {table}.rowid JOIN files ON files.id = strings.file '
+               f'WHERE {table} MATCH ?')
+        params = [match]
+        if name is not None:
+            sql += ' AND files.format = ?'
+            params.append(name)
+        sql += f' ORDER BY {table}.rowid'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return self.db.execute(sql, params).fetchall()
+
+
+def escape(s: str) -> str:
+    return s.replace('\\', '\\\\').replace('\r', '\\r').replace('\n', '\\n').replace('\t', '\\t')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keeps a full-text index of the strings in dumped game files')
+    parser.add_argument('index', help='index database, created if it does not exist')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    add = commands.add_parser('index', help='index (or reindex the changed) files of one format')
+    add.add_argument('format', choices=sorted(formats.FORMATS))
+    add.add_argument('paths', nargs='+', help='files or directories')
+    add.add_argument('-r', '--recursive', help='also index files in subdirectories', action='store_true')
+    add.add_argument('-j', '--jobs', help='number of files to read in parallel (0 for one per CPU)', type=int, default=1)
+    add.add_argument('--region', help='trozei region table (all indexes every one)', default='us')
+    add.add_argument('--language', help='conquest record layout', default='en')
+
+    find = commands.add_parser('query', help='print the strings containing some text')
+    find.add_argument('text')
+    find.add_argument('-f', '--format', choices=sorted(formats.FORMATS), help='only search files of this format')
+    find.add_argument('-n', '--limit', help='maximum number of results (0 for all)', type=int, default=100)
+    args = parser.parse_args()
+
+    with Index(args.index) as index:
+        if args.command == 'index':
+            options = {}
+            if args.format == 'trozei':
+                options['regions'] = formats.load('trozei').REGIONS if args.region == 'all' else [args.region]
+            elif args.format == 'conquest':
+                options['language'] = args.language
+            if index.update(args.format, args.paths, recursive=args.recursive, jobs=args.jobs, **options):
+                sys.exit(1)
+        else:
+            start = time.perf_counter()
+            results = index.search(args.text, name=args.format, limit=args.limit or None)
+            for path, entry, text in results:
+                print(f'{path}\t{entry}\t{escape(text)}')
+            print(f'{len(results)} results in {(time.perf_counter() - start) * 1000:.1f} ms', file=sys.stderr)
@@ -0,0 +1,79 @@
+# Replaces many strings at once in a single pass with longest-match semantics.
+
+import re
+
+
+class Substitution:
+    # Multi-character keys go through one compiled regex, longest first, and
+    # the text between matches goes through a single str.translate, so no
+    # replacement can be rewritten by another one.
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, mapping):
+        self.multi = {a: b for a, b in mapping.items() if len(a) > 1}
+        self.longest = max(map(len, mapping), default=1)
+        self.marks = frozenset(a[-1] for a in self.multi)
+        if self.multi:
+            self.pattern = re.compile('(' + '|'.join(map(re.escape, sorted(self.multi, key=len, reverse=True))) + ')')
+        else:
+            self.pattern = None
+        # A list indexed by code point is a faster translate table than a dict;
+        # anything past the end raises IndexError, which translate leaves as is.
+        singles = {ord(a): b if len(b) != 1 else ord(b) for a, b in mapping.items() if len(a) == 1}
+        self.table = list(range(max(singles, default=-1) + 1))
+        for a, b in singles.items():
+            self.table[a] = b
+        # If no replacement contains a single-character key, translating after
+        # the regex cannot rewrite its output, so the cheaper sub is enough.
+        self.isolated = not any(ord(c) in singles for b in self.multi.values() for c in b)
+
+    def __call__(self, s):
+        if self.pattern is None or not any(mark in s for mark in self.marks):
+            return s.translate(self.table)
+        if self.isolated:
+            return self.pattern.sub(self.substitute, s).translate(self.table)
+        parts = self.pattern.split(s)
+        parts[::2] = [part.translate(self.table) for part in parts[::2]]
+        parts[1::2] = map(self.multi.__getitem__, parts[1::2])
+        return ''.join(parts)
+
+    def substitute(self, match):
+        return self.multi[match[0]]
+
+    def convert_stream(self, src, dst, chunk_size=CHUNK_SIZE):
+        # Anything within the last longest - 1 characters might still be the
+        # start of a key, so it is carried over to the next chunk unconverted.
+        keep = self.longest - 1
+        carry = ''
+        while chunk := src.read(chunk_size):
+            text = carry + chunk
+            converted, pos = self.convert_until(text, len(text) - keep)
+            dst.write(converted)
+            carry = text[pos:]
+        if carry:
+            dst.write(self(carry))
+
+    def convert_until(self, text, cut):
+        # Converts text up to cut, stopping early rather than splitting a match.
+        # Returns the converted text and the position it stopped at.
+        if cut <= 0:
+            return '', 0
+        if self.pattern is None:
+            return text[:cut].translate(self.table), cut
+        out = []
+        pos = 0
+        for i, part in enumerate(self.pattern.split(text)):
+            end = pos + len(part)
+            if end > cut:
+                if not i % 2:
+                    out.append(part[:cut - pos].translate(self.table))
+                    pos = cut
+                break
+            out.append(self.multi[part] if i % 2 else part.translate(self.table))
+            pos = end
+        return ''.join(out), pos
+
+    def convert_file(self, src, dst, src_encoding='utf-8', dst_encoding='utf-8', errors='strict'):
+        with open(src, 'r', encoding=src_encoding, errors=errors) as f, \
+                open(dst, 'w', encoding=dst_encoding) as g:
+            self.convert_stream(f, g)
@@ -0,0 +1,71 @@
+# Loads character tables through a binary cache kept in __pycache__ next to
+# the source file, so repeated runs skip parsing the text entirely.
+
+import hashlib
+import os
+import pickle
+import tempfile
+
+CACHE_VERSION = 1
+
+
+def parse_hex_table(text: str) -> dict[int, str]:
+    # CODE=char lines, with the code in hex
+    table: dict[int, str] = {}
+    for line in text.splitlines(keepends=False):
+        code, char = line.split('=', 1)
+        table[int(code, 16)] = char
+    return table
+
+
+def cache_path(path: str, name: str) -> str:
+    directory, filename = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, '__pycache__', f'{filename}.{name}.pickle')
+
+
+def load(path: str, parse=parse_hex_table, name: str | None = None):
+    """Parse a table file with `parse`, reusing the cached result while the file is unchanged.
+
+    The cache is trusted outright when the file's mtime and size match. Otherwise
+    the file is hashed, and only re-parsed if its contents actually changed."""
+    name = name or parse.__name__
+    cache = cache_path(path, name)
+    stat = os.stat(path)
+    key = (CACHE_VERSION, name)
+
+    header = None
+    try:
+        with open(cache, 'rb') as f:
+            header, value = pickle.load(f)
+        if header[:2] != key or len(header) != 5:
+            header = None
+        elif header[2:4] == (stat.st_mtime_ns, stat.st_size):
+            return value
+    except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        header = None
+
+    with open(path, 'rb') as f:
+        raw = f.read()
+    digest = hashlib.sha256(raw).hexdigest()
+    if header is None or header[4] != digest:
+        # Newlines are translated the same way reading in text mode would.
+        value = parse(raw.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n'))
+    save(cache, (*key, stat.st_mtime_ns, stat.st_size, digest), value)
+    return value
+
+
+def save(cache: str, header: tuple, value):
+    # Written to a temporary file and renamed so a concurrent reader never sees
+    # half a cache; failing to write one (e.g. a read-only checkout) is not an error.
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((header, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    except OSError:
+        pass
@@ -1,144 +1,203 @@
 # Parses out text from .dat files and outputs txt files.
-# Usage: python conquest.py <filename>
+# Usage: python conquest.py [data directory] [output directory] [-l en|ja] [-j jobs] [-e export.sqlite|export.parquet]
 
+import argparse
+import concurrent.futures
+import os
+import struct
 import sys
 
-def pokemon_dat():
-    with open('Pokemon.dat', 'rb') as file:
-        data = file.read()
-        
-        output = ''
-        for i in range(0x0, 0x2580, 0x30):
-            s = data[i:i+11]
-            s = s[:s.find(b'\x00')]
-            s = s.decode('shift_jisx0213')
-            output += str(i // 0x30) + '\t' + s + '\n'
-        
-        with open('Pokemon.txt', 'w', encoding='utf-8') as out:
-            out.write(output)
-
-def skill_dat():
-    with open('Skill.dat', 'rb') as file:
-        data = file.read()
-        
-        output = ''
-        for i in range(0x0, len(data), 20):
-            s = data[i:i+20]
-            s = s[:s.find(b'\x00')]
-            # print(s.decode('shift_jisx0213'))
-            s = s.decode('shift_jisx0213')
-            output += str(i // 20) + '\t' + s + '\n'
-        
-        with open('Skill.txt', 'w', encoding='utf-8') as out:
-            out.write(output)
-            
-def BaseBushou_dat():
-    with open('BaseBushou.dat', 'rb') as file:
-        data = file.read()
-        
-        d = {}
-        special = {
-            'ю': 'ō',
-            'п': 'ū',
-        }
-        for i in range(0x13B0, len(data), 12):
-            s = data[i:i+12]
-            s = s[:s.find(b'\x00')]
-            # print(s.decode('shift_jisx0213'))
-            s = s.decode('shift_jisx0213')
-            for a, b in special.items():
-                s = s.replace(a, b)
-            d[(i - 0x13B0) // 12] = s
-            
-        output = ''
-        for i in range(252):
-            index = (data[i * 20 + 3] * 256 + data[i * 20 + 2] >> 1) & 0xFF
-            output += str(i) + '\t' + str(index) + '\t' + d[index] + '\n'
-        
-        with open('BaseBushou.txt', 'w', encoding='utf-8') as out:
-            out.write(output)
-
-def gimmick_dat_en():
-    with open('Gimmick.dat', 'rb') as file:
-        data = file.read()
-        
-        output = ''
-        for i in range(0x0, len(data), 40):
-            s = data[i:i+16]
-            s = s[:s.find(b'\x00')]
-            # print(s.decode('shift_jisx0213'))
-            s = s.decode('shift_jisx0213').replace('ﾊ', 'é')
-            output += str(i // 40) + '\t' + s + '\n'
-        
-        with open('Gimmick.txt', 'w', encoding='utf-8') as out:
-            out.write(output)
-            
-def gimmick_dat_ja():
-    with open('Gimmick.dat', 'rb') as file:
-        data = file.read()
-        
-        output = ''
-        for i in range(0x0, len(data), 36):
-            s = data[i:i+15]
-            s = s[:s.find(b'\x00')]
-            # print(s.decode('shift_jisx0213'))
-            s = s.decode('shift_jisx0213')
-            output += str(i // 36) + '\t' + s + '\n'
-        
-        with open('Gimmick.txt', 'w', encoding='utf-8') as out:
-            out.write(output)
-            
-def waza_dat(filename='Waza', namelen=15, recordlen=36):
-    with open(filename + '.dat', 'rb') as file:
-        data = file.read()
-        
-        output = ''
-        for i in range(0x0, len(data), recordlen):
-            s = data[i:i+namelen]
-            s = s[:s.find(b'\x00')]
-            # print(s.decode('shift_jisx0213'))
-            s = s.decode('shift_jisx0213')
-            output += str(i // recordlen) + '\t' + s + '\n'
-        
-        with open(filename + '.txt', 'w', encoding='utf-8') as out:
-            out.write(output)
-
-def TrSkill_dat():
-    filename = 'TrSkill'
-    recordlen = 81
-    with open(filename + '.dat', 'rb') as file:
-        data = file.read()
-        
-        output = ''
-        for i in range(0x0, len(data), recordlen):
-            s = data[i:i+0x13]
-            s = s[:s.find(b'\x00')].decode('shift_jisx0213')
-            
-            s2 = data[i+0x13:i+80]
-            s2 = s2[:s2.find(b'\x00')].decode('shift_jisx0213')
-            
-            output += str(i // recordlen) + '\t' + s + '\t' + s2 + '\n'
-        
-        with open(filename + '.txt', 'w', encoding='utf-8') as out:
-            out.write(output)
-
-pokemon_dat()
-skill_dat()
-BaseBushou_dat()
-gimmick_dat_en()
-waza_dat()
-waza_dat('Item', 0x15)
-waza_dat('Building', 0x13) # en
-# waza_dat('Building', 0x11, 32) # ja
-waza_dat('Tokusei', 0x10, 20)
-waza_dat('SpAbility', 19, 19)
-waza_dat('Trainer', 0x14, 44)
-waza_dat('Trainer', 0x14, 44)
-waza_dat('Saihai', 0x13, 28) # en
-# waza_dat('Saihai', 0xF, 24) # ja
-TrSkill_dat()
-waza_dat('EventSpeaker', 0x10, 18) # en
-# waza_dat('EventSpeaker', 11, 12) # ja
-waza_dat('Kuni', 0xB, 24) # en
-# waza_dat('Kuni', 9, 20) # ja
-waza_dat('Jinkei', 0x10, 28)
\ No newline at end of file
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import export
+from common.substitution import Substitution
+
+ENCODING = 'shift_jisx0213'
+# one row per string: a record with several strings gets a row for each field
+EXPORT_COLUMNS = [('id', int), ('field', int), ('text', str)]
+
+
+class Table:
+    # A .dat file made of fixed-length records, each holding null-terminated Shift JIS strings
+    # at fixed (offset, length) positions. A string without a terminator loses its last byte.
+
+    def __init__(self, name, record_length, fields, language=None, *, start=0, count=None, replace=None):
+        self.name = name
+        self.record_length = record_length
+        self.fields = fields
+        self.language = language  # None for tables that are the same in every language
+        self.start = start
+        self.count = count  # None to read records until the end of the file
+        self.replace = Substitution(replace) if replace else None
+
+        # one struct covering a whole record, skipping the bytes between the fields
+        fmt = '<'
+        pos = 0
+        for offset, length in fields:
+            if offset < pos:
+                raise ValueError(f'{name}: fields must be in order and must not overlap')
+            fmt += (f'{offset - pos}x' if offset > pos else '') + f'{length}s'
+            pos = offset + length
+        if pos > record_length:
+            raise ValueError(f'{name}: fields run past the end of the record')
+        self.struct = struct.Struct(fmt + (f'{record_length - pos}x' if record_length > pos else ''))
+
+    def records(self, view):
+        # The raw fields of every record. Whole records are unpacked in bulk; a record cut
+        # short by the end of the file is sliced field by field, like the rest of the file was.
+        end = len(view) if self.count is None else self.start + self.count * self.record_length
+        count = max(-(-(end - self.start) // self.record_length), 0)
+        full = max(min(end, len(view)) - self.start, 0) // self.record_length
+        with view[self.start:self.start + full * self.record_length] as body:
+            records = list(self.struct.iter_unpack(body))
+        for i in range(self.start + full * self.record_length, self.start + count * self.record_length, self.record_length):
+            records.append(tuple(bytes(view[i + offset:i + offset + length]) for offset, length in self.fields))
+        return records
+
+    def read(self, data):
+        """Decode the string fields of every record, as a list of rows."""
+        with memoryview(data) as view:
+            records = self.records(view)
+        strings = [s[:s.find(b'\x00')] for record in records for s in record]
+        if not strings:
+            return []
+        # Cut at their terminator, the strings hold no nulls, and a null is never part of a
+        # multibyte character, so they can all be decoded (and replaced) together.
+        try:
+            text = b'\x00'.join(strings).decode(ENCODING)
+        except UnicodeDecodeError:
+            text = None
+        if text is None:
+            # decoded one by one to raise the error for the string at fault
+            text = '\x00'.join(s.decode(ENCODING) for s in strings)
+        if self.replace is not None:
+            text = self.replace(text)
+        strings = text.split('\x00')
+        return list(zip(*[iter(strings)] * len(self.fields)))
+
+    def rows(self, data):
+        return self.read(data)
+
+    def dump(self, src='.', dst=None):
+        # src and dst are directories; the files are named after the table. Returns the path
+        # written and the rows, so they can be exported without reading the file again.
+        dst_fn = os.path.join(src if dst is None else dst, self.name + '.txt')
+        return dst_fn, self.dump_file(os.path.join(src, self.name + '.dat'), dst_fn)
+
+    def dump_file(self, src, dst):
+        with open(src, 'rb') as file:
+            rows = self.rows(file.read())
+        with open(dst, 'w', encoding='utf-8') as out:
+            out.writelines(f'{i}\t' + '\t'.join(row) + '\n' for i, row in enumerate(rows))
+        return rows
+
+
+class Officers(Table):
+    # Each record refers to a name by an index stored in the bits 1-8 of its u16 at offset 2
+
+    def __init__(self, name, record_length, names, *, count):
+        super().__init__(name, record_length, [], count=count)
+        self.names = names
+        self.index = struct.Struct(f'<2xH{record_length - 4}x')
+
+    def rows(self, data):
+        names = [name for name, in self.names.read(data)]
+        with memoryview(data) as view, view[:self.count * self.record_length] as body:
+            indices = [(value >> 1) & 0xFF for value, in self.index.iter_unpack(body)]
+        return [(str(index), names[index]) for index in indices]
+
+
+TABLES = [
+    # name, record length, (offset, length) of each string, language
+    Table('Pokemon', 0x30, [(0, 11)], count=200),
+    Table('Skill', 20, [(0, 20)]),
+    Officers('BaseBushou', 20, Table('BaseBushou', 12, [(0, 12)], start=0x13B0, replace={'ю': 'ō', 'п': 'ū'}), count=252),
+    Table('Gimmick', 40, [(0, 16)], 'en', replace={'ﾊ': 'é'}),
+    Table('Gimmick', 36, [(0, 15)], 'ja'),
+    Table('Waza', 36, [(0, 15)]),
+    Table('Item', 36, [(0, 0x15)]),
+    Table('Building', 36, [(0, 0x13)], 'en'),
+    Table('Building', 32, [(0, 0x11)], 'ja'),
+    Table('Tokusei', 20, [(0, 0x10)]),
+    Table('SpAbility', 19, [(0, 19)]),
+    Table('Trainer', 44, [(0, 0x14)]),
+    Table('Saihai', 28, [(0, 0x13)], 'en'),
+    Table('Saihai', 24, [(0, 0xF)], 'ja'),
+    Table('TrSkill', 81, [(0, 0x13), (0x13, 80 - 0x13)]),
+    Table('EventSpeaker', 18, [(0, 0x10)], 'en'),
+    Table('EventSpeaker', 12, [(0, 11)], 'ja'),
+    Table('Kuni', 24, [(0, 0xB)], 'en'),
+    Table('Kuni', 20, [(0, 9)], 'ja'),
+    Table('Jinkei', 28, [(0, 0x10)]),
+]
+
+LANGUAGES = sorted({table.language for table in TABLES} - {None})
+
+
+def tables(language='en'):
+    # one table per .dat file, so each file is read once
+    return {table.name: table for table in TABLES if table.language in (None, language)}
+
+
+def dump_table(name, language, src='.', dst=None, rows=False):
+    # Tables are looked up by name in the worker, since their structs can't be pickled.
+    # With rows, the rows for common.export are returned too, from the same read.
+    dst_fn, table_rows = tables(language)[name].dump(src, dst)
+    if rows:
+        return dst_fn, records(table_rows)
+    return dst_fn
+
+
+def records(rows):
+    # one (record, field, text) row per string, as exported
+    return [(i, j, text) for i, row in enumerate(rows) for j, text in enumerate(row)]
+
+
+def export_rows(path, language='en'):
+    # (record, field, text) rows of a .dat file for common.export, picking its table by name;
+    # other .dat files hold no text, so they have no rows
+    table = tables(language).get(os.path.splitext(os.path.basename(path))[0])
+    if table is None:
+        return []
+    with open(path, 'rb') as file:
+        return records(table.rows(file.read()))
+
+
+def dump(src='.', dst=None, language='en', jobs=0, export_path=None):
+    # Dumps every table for the language across a process pool, and optionally exports the ones
+    # that dumped to one SQLite or Parquet file. Returns the number of tables that failed.
+    if dst is not None:
+        os.makedirs(dst, exist_ok=True)
+    failed = 0
+    with export.open_exporter(export_path) as exporter, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=jobs or None) as executor:
+        futures = {executor.submit(dump_table, name, language, src, dst, rows=exporter is not None): name
+                   for name in tables(language)}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                print(f'{futures[future]}.dat: {type(e).__name__}: {e}', file=sys.stderr)
+                continue
+            if exporter is None:
+                print(result)
+                continue
+            dst_fn, rows = result
+            print(dst_fn)
+            failed += export.write_file(exporter, 'conquest', EXPORT_COLUMNS, os.path.join(src, futures[future] + '.dat'),
+                                        rows, index=['id'])
+    if export_path:
+        print(export_path)
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parses out text from .dat files from Pokémon Conquest and outputs txt files')
+    parser.add_argument('src', nargs='?', default='.', help='directory containing the .dat files (defaults to the current directory)')
+    parser.add_argument('dst', nargs='?', help='output directory (defaults to src)')
+    parser.add_argument('-l', '--language', choices=LANGUAGES, default='en', help='record layout to read the files with')
+    parser.add_argument('-j', '--jobs', help='number of files to dump in parallel (0 for one per CPU)', type=int, default=0)
+    parser.add_argument('-e', '--export', help='also write the rows to this .sqlite/.db or .parquet file')
+    args = parser.parse_args()
+    if dump(args.src, args.dst, args.language, args.jobs, args.export):
+        sys.exit(1)
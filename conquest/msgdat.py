@@ -1,321 +1,304 @@
 # Parses a MSG.DAT file and outputs txt files.
-# Usage: python msgdat.py <filename>
+# Usage: python msgdat.py <filename> [output directory] [-e export.sqlite|export.parquet]
 
-import sys
+import argparse
+import mmap
 import os
-from itertools import chain
+import struct
+from itertools import islice
 import re
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import export, kana
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-RAW_OUT = False
 
 def read_val(data, index, length=4):
     return int.from_bytes(data[index:index+length], byteorder='little', signed=False)
 
 
+KEY = b"MsgLinker Ver1.00"
+EXPORT_COLUMNS = [('block', int), ('string', int), ('text', str)]
+
+def keystream(length):
+    return (KEY * (length // len(KEY) + 1))[:length]
+
+
 def decrypt(data):
-    data = list(data)
-    key = b"MsgLinker Ver1.00"
-    
-    for i in range(len(data)):
-        data[i] = data[i] ^ key[i % len(key)]
-    
-    return bytes(data)
+    # XOR the whole block against the repeated key at once; XOR is its own inverse, so this also encrypts
+    if numpy is not None:
+        return (numpy.frombuffer(data, numpy.uint8) ^ numpy.frombuffer(keystream(len(data)), numpy.uint8)).tobytes()
+    n = int.from_bytes(data, byteorder='little') ^ int.from_bytes(keystream(len(data)), byteorder='little')
+    return n.to_bytes(len(data), byteorder='little')
+
+encrypt = decrypt
+
+
+def decrypt_into(buffer):
+    # Decrypt a writable buffer in place, e.g. a memoryview slice of a bytearray
+    view = memoryview(buffer).cast('B')
+    if numpy is not None:
+        array = numpy.frombuffer(view, numpy.uint8)
+        numpy.bitwise_xor(array, numpy.frombuffer(keystream(len(view)), numpy.uint8), out=array)
+    else:
+        view[:] = decrypt(view)
+
+encrypt_into = decrypt_into
     
 
 def process_string(string):
     # string = string[0:string.find(b'\x05\x05\x05')]
     # string = string.replace(b'{', b'\\{').replace(b'}', b'\\}').replace(b'[', b'\\[').replace(b']', b'\\]')
     string = string.decode('shift_jisx0213').replace('¥', '\\')
-    
-    # print(string)
-    
-    string = string.replace('\\', '\\\\').replace('\r', '\\r').replace('\n', '\\n').replace('\t', '\\t')
-    for j in chain(range(0x00, 0x20)):# , range(0x80, 0xFF)):
-        string = string.replace(chr(j), '\\x' + hex(j)[2:].zfill(2))
-    string = process_ruby(string)
-    string = process_ctrl(string)
-    string = process_kana(string)
-        
-    return string
-
-
-def process_kana(s):
-    while r'\x1bK' in s and r'\x1bH' in s:
-        if s.find(r'\x1bH') < s.find(r'\x1bK'):
-            s = s[:s.find(r'\x1bH')] + s[s.find(r'\x1bH') + 5:]
-        x = s[s.find(r'\x1bK'):s.find(r'\x1bH') + 5]
-        s = s.replace(x, to_katakana(x))
-    return to_hiragana(s.replace(r'\x1bK', '{K}').replace(r'\x1bH', ''))
-
-
-KATAKANA = {
-	'ｶﾞ': 'ガ',
-	'ｷﾞ': 'ギ',
-	'ｸﾞ': 'グ',
-	'ｹﾞ': 'ゲ',
-	'ｺﾞ': 'ゴ',
-	'ｻﾞ': 'ザ',
-	'ｼﾞ': 'ジ',
-	'ｽﾞ': 'ズ',
-	'ｾﾞ': 'ゼ',
-	'ｿﾞ': 'ゾ',
-	'ﾀﾞ': 'ダ',
-	'ﾁﾞ': 'ヂ',
-	'ﾂﾞ': 'ヅ',
-	'ﾃﾞ': 'デ',
-	'ﾄﾞ': 'ド',
-	'ﾊﾞ': 'バ',
-	'ﾋﾞ': 'ビ',
-	'ﾌﾞ': 'ブ',
-	'ﾍﾞ': 'ベ',
-	'ﾎﾞ': 'ボ',
-	'ﾊﾟ': 'パ',
-	'ﾋﾟ': 'ピ',
-	'ﾌﾟ': 'プ',
-	'ﾍﾟ': 'ペ',
-	'ﾎﾟ': 'ポ',
-	'ｳﾞ': 'ヴ',
-	'ｱ': 'ア',
-	'ｲ': 'イ',
-	'ｳ': 'ウ',
-	'ｴ': 'エ',
-	'ｵ': 'オ',
-	'ｶ': 'カ',
-	'ｷ': 'キ',
-	'ｸ': 'ク',
-	'ｹ': 'ケ',
-	'ｺ': 'コ',
-	'ｻ': 'サ',
-	'ｼ': 'シ',
-	'ｽ': 'ス',
-	'ｾ': 'セ',
-	'ｿ': 'ソ',
-	'ﾀ': 'タ',
-	'ﾁ': 'チ',
-	'ﾂ': 'ツ',
-	'ﾃ': 'テ',
-	'ﾄ': 'ト',
-	'ﾅ': 'ナ',
-	'ﾆ': 'ニ',
-	'ﾇ': 'ヌ',
-	'ﾈ': 'ネ',
-	'ﾉ': 'ノ',
-	'ﾊ': 'ハ',
-	'ﾋ': 'ヒ',
-	'ﾌ': 'フ',
-	'ﾍ': 'ヘ',
-	'ﾎ': 'ホ',
-	'ﾏ': 'マ',
-	'ﾐ': 'ミ',
-	'ﾑ': 'ム',
-	'ﾒ': 'メ',
-	'ﾓ': 'モ',
-	'ﾔ': 'ヤ',
-	'ﾕ': 'ユ',
-	'ﾖ': 'ヨ',
-	'ﾗ': 'ラ',
-	'ﾘ': 'リ',
-	'ﾙ': 'ル',
-	'ﾚ': 'レ',
-	'ﾛ': 'ロ',
-	'ﾜ': 'ワ',
-	'ｦ': 'ヲ',
-	'ﾝ': 'ン',
-	'ｧ': 'ァ',
-	'ｨ': 'ィ',
-	'ｩ': 'ゥ',
-	'ｪ': 'ェ',
-	'ｫ': 'ォ',
-	'ｬ': 'ャ',
-	'ｭ': 'ュ',
-	'ｮ': 'ョ',
-	'ｯ': 'ッ'
-}
+    return StringTokenizer(string).render()
+
+
 def to_katakana(s):
-    s = s.replace(r'\x1bK', '').replace(r'\x1bH', '')
-    for a, b in KATAKANA.items():
-        s = s.replace(a, b)
-    return s
-    
+    return kana.to_katakana(s.replace(r'\x1bK', '').replace(r'\x1bH', ''))
+
 
-HIRAGANA = {
-	'ｶﾞ': 'が',
-	'ｷﾞ': 'ぎ',
-	'ｸﾞ': 'ぐ',
-	'ｹﾞ': 'げ',
-	'ｺﾞ': 'ご',
-	'ｻﾞ': 'ざ',
-	'ｼﾞ': 'じ',
-	'ｽﾞ': 'ず',
-	'ｾﾞ': 'ぜ',
-	'ｿﾞ': 'ぞ',
-	'ﾀﾞ': 'だ',
-	'ﾁﾞ': 'ぢ',
-	'ﾂﾞ': 'づ',
-	'ﾃﾞ': 'で',
-	'ﾄﾞ': 'ど',
-	'ﾊﾞ': 'ば',
-	'ﾋﾞ': 'び',
-	'ﾌﾞ': 'ぶ',
-	'ﾍﾞ': 'べ',
-	'ﾎﾞ': 'ぼ',
-	'ﾊﾟ': 'ぱ',
-	'ﾋﾟ': 'ぴ',
-	'ﾌﾟ': 'ぷ',
-	'ﾍﾟ': 'ぺ',
-	'ﾎﾟ': 'ぽ',
-	'ｳﾞ': 'ゔ',
-	'ｱ': 'あ',
-	'ｲ': 'い',
-	'ｳ': 'う',
-	'ｴ': 'え',
-	'ｵ': 'お',
-	'ｶ': 'か',
-	'ｷ': 'き',
-	'ｸ': 'く',
-	'ｹ': 'け',
-	'ｺ': 'こ',
-	'ｻ': 'さ',
-	'ｼ': 'し',
-	'ｽ': 'す',
-	'ｾ': 'せ',
-	'ｿ': 'そ',
-	'ﾀ': 'た',
-	'ﾁ': 'ち',
-	'ﾂ': 'つ',
-	'ﾃ': 'て',
-	'ﾄ': 'と',
-	'ﾅ': 'な',
-	'ﾆ': 'に',
-	'ﾇ': 'ぬ',
-	'ﾈ': 'ね',
-	'ﾉ': 'の',
-	'ﾊ': 'は',
-	'ﾋ': 'ひ',
-	'ﾌ': 'ふ',
-	'ﾍ': 'へ',
-	'ﾎ': 'ほ',
-	'ﾏ': 'ま',
-	'ﾐ': 'み',
-	'ﾑ': 'む',
-	'ﾒ': 'め',
-	'ﾓ': 'も',
-	'ﾔ': 'や',
-	'ﾕ': 'ゆ',
-	'ﾖ': 'よ',
-	'ﾗ': 'ら',
-	'ﾘ': 'り',
-	'ﾙ': 'る',
-	'ﾚ': 'れ',
-	'ﾛ': 'ろ',
-	'ﾜ': 'わ',
-	'ｦ': 'を',
-	'ﾝ': 'ん',
-	'ｧ': 'ぁ',
-	'ｨ': 'ぃ',
-	'ｩ': 'ぅ',
-	'ｪ': 'ぇ',
-	'ｫ': 'ぉ',
-	'ｬ': 'ゃ',
-	'ｭ': 'ゅ',
-	'ｮ': 'ょ',
-	'ｯ': 'っ'
-}
 def to_hiragana(s):
-    s = s.replace(r'\x1bK', '').replace(r'\x1bH', '')
-    for a, b in HIRAGANA.items():
-        s = s.replace(a, b)
-    return s
+    return kana.to_hiragana(s.replace(r'\x1bK', '').replace(r'\x1bH', ''))
 
 
 RUBY_CHAR = ['[', ']']
-def process_ruby(s):
-    i = 0
-    while r'\x1br' in s:
-        s = s.replace(r'\x1br', RUBY_CHAR[i], 1)
-        i = (i + 1) % 2
-    return s
-
 
 CONTROL_CODES = {
-    '\\x00': '{NULL}',
-    '\\x01"': '{C1}',
-    '\\x1bc\x31': '{Color:31}',
-    '\\x1bc\x32': '{Color:32}',
-    '\\x1bc\x33': '{Color:33}',
-    r'\x05\x05\x04': '\n\t{Sub}',
-    r'\x01S%3': '{S%3}',
-    r'\x05\x05\x05': '{End}',
-    r'\x1bkﾊ': 'é',
-    r'\x1bkﾁ': 'à'
+    '\x00': '{NULL}',
+    '\x01"': '{C1}',
+    '\x1bc1': '{Color:31}',
+    '\x1bc2': '{Color:32}',
+    '\x1bc3': '{Color:33}',
+    '\x05\x05\x04': '\n\t{Sub}',
+    '\x01S%3': '{S%3}',
+    '\x05\x05\x05': '{End}',
+    '\x1bkﾊ': 'é',
+    '\x1bkﾁ': 'à'
+}
+
+# Control codes that take a one-byte parameter: name, rank
+PARAM_CODES = {
+    '\x1bc': ('Color', 3),
+    '\x1bw': ('Wait', 4),
+    '\x1bs': ('NameColor', 5),
+    '\x1bf': ('CharImage', 6),
 }
-def process_ctrl(s):
-    for a, b in CONTROL_CODES.items():
-        if a in s:
-            s = s.replace(a, b)
-    
-    while r'\x1bc' in s:
-        i = s.find(r'\x1bc')
-        if s[i+5] != '\\':
-            s = s[:i] + '{Color:' + s[i+5].encode('shift_jisx0213').hex() + '}' + s[i+6:]
-        else:
-            s = s[:i] + '{Color:' + s[i+7:i+9] + '}' + s[i+6:]
-    while r'\x1bw' in s:
-        i = s.find(r'\x1bw')
-        if s[i+5] != '\\':
-            s = s[:i] + '{Wait:' + s[i+5].encode('shift_jisx0213').hex() + '}' + s[i+6:]
-        else:
-            s = s[:i] + '{Wait:' + s[i+7:i+9] + '}' + s[i+6:]
-    while r'\x1bs' in s:
-        i = s.find(r'\x1bs')
-        if s[i+5] != '\\':
-            s = s[:i] + '{NameColor:' + s[i+5].encode('shift_jisx0213').hex() + '}' + s[i+6:]
-        else:
-            s = s[:i] + '{NameColor:' + s[i+7:i+9] + '}' + s[i+6:]
-    while r'\x1bf' in s:
-        i = s.find(r'\x1bf')
-        if s[i+5] != '\\':
-            s = s[:i] + '{CharImage:' + s[i+5].encode('shift_jisx0213').hex() + '}' + s[i+6:]
-        else:
-            s = s[:i] + '{CharImage:' + s[i+7:i+9] + '}' + s[i+6:]
-    while r'\x1b@' in s:
-        i = s.find(r'\x1b@')
-        if s[i+5] != '\\':
-            s = s[:i] + '{Char:' + s[i+5:i+9] + '}' + s[i+9:]
-    while r'\x02' in s:
-        i = s.find(r'\x02')
-        if s[i+4] != '\\':
-            s = s[:i] + '{Var:' + s[i+4:i+6].encode('shift_jisx0213').hex() + '}' + s[i+6:]
-    
-    return s
 
+ESCAPES = {'\\': '\\\\', '\r': '\\r', '\n': '\\n', '\t': '\\t'}
+ESCAPES |= {chr(j): '\\x' + hex(j)[2:].zfill(2) for j in range(0x00, 0x20) if chr(j) not in ESCAPES}
 
-with open(sys.argv[1], 'rb') as file:
-    data = file.read()
-    
-    i = 0
-    while data[i:i + 8] != b"\x00\x00\x00\x00\x00\x00\x00\x00":
-        start = read_val(data, i)
-        end = read_val(data, i + 4) + start
-        # print(hex(start), hex(end))
-        
-        raw = decrypt(data[start:end])
-        if RAW_OUT:
-            with open(os.path.dirname(sys.argv[1]) + '\\' + str(i // 8) + '.msg', 'wb') as out:
-                out.write(raw)
-            # break
-            continue
-        
+TOKEN = re.compile('|'.join([
+    '(?P<ruby>\x1br)',
+    # {Sub} used to be replaced before {End}, so it takes the last two of a run of \x05 followed by \x04
+    '(?P<code>' + '|'.join(re.escape(code) + ('(?!\x05?\x04)' if code == '\x05\x05\x05' else '')
+                           for code in CONTROL_CODES) + ')',
+    '(?P<param>' + '|'.join(map(re.escape, PARAM_CODES)) + ')',
+    '(?P<char>\x1b@)',
+    '(?P<var>\x02)',
+    '(?P<kana>\x1b[KH])',
+    '(?P<escape>[\x00-\x1f\\\\])',
+    '(?P<text>[^\x00-\x1f\\\\]+)',
+]))
+
+# The order in which the codes used to be replaced, one pass each over the whole string.
+# A code only sees the output of the codes ranked before it; later codes still look like escape sequences.
+RANKS = {'escape': 0, 'ruby': 1, 'code': 2, 'char': 7, 'var': 8, 'kana': 9}
+
+
+def escape(s):
+    return ''.join(ESCAPES.get(c, c) for c in s)
+
+
+class StringTokenizer:
+    # Converts a decoded string in a single pass, producing the same output as escaping it and then replacing
+    # ruby, control codes, parameters and kana shifts one after the other
+
+    def __init__(self, s):
+        self.tokens = [(match.lastgroup, match.group()) for match in TOKEN.finditer(s)]
+        self.pos = 0
+        self.ruby = 0
+
+    def render(self):
+        # A katakana shift only takes effect once a hiragana shift closes it; otherwise each shift is shown as {K}
+        segments = []  # (is katakana, pieces), with None marking a katakana shift
+        pieces = []
+        shifted = False
+        while self.pos < len(self.tokens):
+            kind, text = self.tokens[self.pos]
+            if kind != 'kana':
+                pieces.append(self.view(RANKS['kana']))
+                continue
+
+            self.pos += 1
+            if text == '\x1bK':
+                if not shifted:
+                    segments.append((False, pieces))
+                    pieces = []
+                    shifted = True
+                pieces.append(None)
+            elif shifted:
+                segments.append((True, pieces))
+                pieces = []
+                shifted = False
+        segments.append((False, pieces))
+
+        # Remaining halfwidth kana become hiragana, including any dakuten left over at the start of a katakana shift
+        return to_hiragana(''.join(
+            to_katakana(''.join(piece for piece in pieces if piece is not None)) if katakana
+            else ''.join('{K}' if piece is None else piece for piece in pieces)
+            for katakana, pieces in segments))
+
+    @staticmethod
+    def rank(kind, text):
+        return PARAM_CODES[text][1] if kind == 'param' else RANKS[kind]
+
+    def view(self, rank):
+        # Consume the next token, returning it as it appeared to the pass with the given rank
+        kind, text = self.tokens[self.pos]
+        self.pos += 1
+        if kind == 'text':
+            return text
+        if kind == 'escape' or self.rank(kind, text) >= rank:
+            return escape(text)
+        return self.convert(kind, text)
+
+    def peek(self, rank, length):
+        # Look ahead without consuming, for the few codes that read further than their parameter
+        v = ''
+        ruby = self.ruby
+        for kind, text in islice(self.tokens, self.pos, None):
+            if len(v) >= length:
+                break
+            if kind == 'text' or kind == 'escape' or self.rank(kind, text) >= rank:
+                v += escape(text)
+            elif kind == 'ruby':
+                v += RUBY_CHAR[ruby]
+                ruby ^= 1
+            elif kind == 'code':
+                v += CONTROL_CODES[text]
+            else:
+                v += '{' + (PARAM_CODES[text][0] if kind == 'param' else kind.title()) + ':'  # only the start is needed
+        return v
+
+    def pull(self, rank, length):
+        v = ''
+        while len(v) < length and self.pos < len(self.tokens):
+            v += self.view(rank)
+        return v
+
+    def convert(self, kind, text):
+        match kind:
+            case 'ruby':
+                self.ruby ^= 1
+                return RUBY_CHAR[self.ruby ^ 1]
+            case 'code':
+                return CONTROL_CODES[text]
+            case 'param':
+                name, rank = PARAM_CODES[text]
+                if self.pos == len(self.tokens):
+                    return escape(text)
+                v = self.view(rank)
+                if v[0] != '\\':
+                    return '{' + name + ':' + v[0].encode('shift_jisx0213').hex() + '}' + v[1:]
+                # an escaped parameter only has its hex digits taken, leaving the rest of the escape sequence behind
+                digits = (v if len(v) >= 4 else v + self.peek(rank, 4 - len(v)))[2:4]
+                return '{' + name + ':' + digits + '}' + v[1:]
+            case 'char':
+                v = self.pull(RANKS['char'], 4)
+                return '{Char:' + v[:4] + '}' + v[4:]
+            case 'var':
+                v = self.pull(RANKS['var'], 2)
+                return '{Var:' + v[:2].encode('shift_jisx0213').hex() + '}' + v[2:]
+
+
+class MsgDat:
+    POINTER_FORMAT = '<II'
+
+    def __init__(self, data):
+        self.data = data
+        self.view = memoryview(data)
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return cls(b'')
+            return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def close(self):
+        self.view.release()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def iter_pointers(self):
+        # (start, length) pairs, terminated by an all-zero entry
+        for i in range(0, len(self.view) - 7, 8):
+            start, length = struct.unpack_from(self.POINTER_FORMAT, self.view, i)
+            if start == 0 and length == 0:
+                break
+            yield start, length
+
+    def iter_blocks(self):
+        for start, length in self.iter_pointers():
+            yield decrypt(self.view[start:start + length])
+
+    @staticmethod
+    def iter_block_strings(raw):
         count = read_val(raw, 0)
-        pointers = [read_val(raw, 4 + i * 4) for i in range(count)] + [len(raw)]
-        # print([hex(i) for i in pointers])
-        
-        output = ""
-        for j in range(len(pointers) - 1):
-            string = raw[pointers[j]:pointers[j + 1]]                    
-            output += str(j) + '\t' + process_string(string) + '\n'
-            
-        with open(os.path.dirname(sys.argv[1]) + '\\' + str(i // 8) + '.txt', 'w', encoding='utf-8') as out:
-            out.write(output)
-        
-        i += 8
+        pointers = list(struct.unpack_from(f'<{count}I', raw, 4)) + [len(raw)]
+        for j in range(count):
+            yield raw[pointers[j]:pointers[j + 1]]
+
+    def iter_strings(self):
+        # (block index, string index, text) for every string in the archive
+        for i, raw in enumerate(self.iter_blocks()):
+            for j, string in enumerate(self.iter_block_strings(raw)):
+                yield i, j, process_string(string)
+
+
+def dump(src, dst=None, raw=False):
+    if dst is None:
+        dst = os.path.dirname(src)
+    with MsgDat.open(src) as msgdat:
+        for i, block in enumerate(msgdat.iter_blocks()):
+            if raw:
+                with open(os.path.join(dst, f'{i}.msg'), 'wb') as out:
+                    out.write(block)
+                continue
+
+            with open(os.path.join(dst, f'{i}.txt'), 'w', encoding='utf-8') as out:
+                out.writelines(f'{j}\t{process_string(string)}\n'
+                               for j, string in enumerate(msgdat.iter_block_strings(block)))
+
+
+def export_rows(src):
+    # (block index, string index, text) rows for common.export, with the text as it is dumped
+    with MsgDat.open(src) as msgdat:
+        return list(msgdat.iter_strings())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='msgdat.py', description='Parses a MSG.DAT file from Pokémon Conquest and outputs txt files')
+    parser.add_argument('src', help='MSG.DAT path')
+    parser.add_argument('dst', nargs='?', help='output directory (defaults to the directory containing src)')
+    parser.add_argument('--raw', help='output the decrypted blocks instead of text', action='store_true')
+    parser.add_argument('-e', '--export', help='also write the rows to this .sqlite/.db or .parquet file')
+    args = parser.parse_args()
+    if args.raw and args.export:
+        parser.error('raw blocks cannot be exported')
+    dump(args.src, args.dst, raw=args.raw)
+    if args.export:
+        if export.export_files(args.export, 'msgdat', EXPORT_COLUMNS, export_rows, [args.src], index=['block']):
+            sys.exit(1)
+        print(args.export)
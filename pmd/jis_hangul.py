@@ -1,13 +1,21 @@
 ﻿# Parses hangul encoded as kanji in EUC-JP to UTF-8.
 # Requires Table.tbl file.
 # Usage: python jis_hangul.py f <input file> <output file>
+#        python jis_hangul.py c <input file>
 #        python jis_hangul.py
 
+import os
 import sys
 
-in_file  = sys.argv[2]
-out_file = sys.argv[3]
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import tables
+from common.substitution import Substitution
 
+in_file  = sys.argv[2] if len(sys.argv) > 2 else None
+out_file = sys.argv[3] if len(sys.argv) > 3 else None
+
+# Reference implementations, one replace pass per pair in order. Only used to
+# check the single-pass encoder and decoder below.
 def encode_text(text, map):
 	for i, j in map:
 		text = text.replace(j, i)
@@ -18,6 +26,17 @@ def decode_text(text, map):
 		text = text.replace(i, j)
 	return text
 
+def parse_table(text):
+	# Each row is a hangul syllable and its index into the EUC-JP kanji rows.
+	return [[bytearray([(int(i, 16) + 479) // 94 + 161, (int(i, 16) + 479) % 94 + 161])
+				.decode('euc-jp'), j] # .encode('shift-jis'), j]
+				for i, j in [line.split('=')
+				for line in text.split('\n')]]
+
+table_path = 'Table.tbl'
+if not os.path.exists(table_path):
+	table_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), table_path)
+
 mapping =  [['蔽', 'ㄱ'], ['閉', 'ㄲ'], ['米', 'ㄴ'], ['壁', 'ㄷ'], ['癖', 'ㄸ'], ['碧', 'ㄹ'], ['篇', 'ㅁ'], ['編', 'ㅂ'],
 			['辺', 'ㅃ'], ['遍', 'ㅅ'], ['便', 'ㅆ'], ['勉', 'ㅇ'], ['娩', 'ㅈ'], ['弁', 'ㅉ'], ['鞭', 'ㅊ'], ['保', 'ㅋ'],
 			['舗', 'ㅌ'], ['鋪', 'ㅍ'], ['圃', 'ㅎ'], ['捕', 'ㅏ'], ['歩', 'ㅐ'], ['甫', 'ㅑ'], ['補', 'ㅒ'], ['輔', 'ㅓ'],
@@ -25,20 +44,38 @@ mapping =  [['蔽', 'ㄱ'], ['閉', 'ㄲ'], ['米', 'ㄴ'], ['壁', 'ㄷ'], ['
 			['宝', 'ㅣ'], ['捧', '…'], ['放', '♂'], ['方', '♀'], ['朋', '-'], ['法', '갹'], [' 泡', '꼍'], ['烹', '늄'],
 			['砲', '떽'], ['縫', '맒'], ['胞', '봄'], ['芳', '섹'], ['萌', '씸'], ['蓬', '음'], ['蜂', '쩍'], ['褒', '캭'],
 			['訪', '틱'], ['豊', '횟']] + \
-			[[bytearray([(int(i, 16) + 479) // 94 + 161, (int(i, 16) + 479) % 94 + 161])
-				.decode('euc-jp'), j] # .encode('shift-jis'), j]
-				for i, j in [line.split('=')
-				for line in open('Table.tbl', encoding='utf-8').read().split('\n')]]
+			tables.load(table_path, parse_table, 'jis_hangul')
+
+def first_wins(pairs):
+	# A key that appears twice keeps its first value, as the replace passes did.
+	table = {}
+	for i, j in pairs:
+		table.setdefault(i, j)
+	return table
+
+decoder = Substitution(first_wins(mapping))
+encoder = Substitution(first_wins((j, i) for i, j in mapping))
 
-if sys.argv[1] == "f":
+mode = sys.argv[1] if len(sys.argv) > 1 else None
+
+if mode == "f":
+	decoder.convert_file(in_file, out_file, 'shift-jis', 'utf-8', errors='ignore')
+	print("Done!")
+elif mode == "c":
 	t = open(in_file, 'r', encoding='shift-jis', errors='ignore').read()
-	t = decode_text(t, mapping)
-	open(out_file, 'w', encoding='utf-8').write(t)
+	u = decode_text(t, mapping)
+	checks = [('decode', decoder(t), u), ('encode', encoder(u), encode_text(u, mapping))]
+	for name, a, b in checks:
+		if a == b:
+			print(name + ": OK")
+		else:
+			k = next((k for k, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+			print(name + ": differs at character " + str(k) + ": " + repr(a[k:k + 20]) + " != " + repr(b[k:k + 20]))
 	print("Done!")
 else:
 	t = input("Input: ") # open(in_file, 'r', encoding='shift-jis', errors='ignore').read()
-	t = encode_text(t, mapping)
+	t = encoder(t)
 	print(t) # open(out_file, 'w', encoding='utf-8').write(t)
-	t = decode_text(t, mapping)
+	t = decoder(t)
 	print(t) # open(out_file, 'w', encoding='utf-8').write(t)
 	print("Done!")
\ No newline at end of file
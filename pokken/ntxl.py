@@ -1,67 +1,337 @@
 # Parses NTXL files and outputs a txt file.
-# Usage: python ntxl.py <filename>
+# Usage: python ntxl.py <filename> [output file] [-e export.sqlite|export.parquet]
+#        python ntxl.py -p <original ntxl> <txt file> <output ntxl> [-v]
+#        python ntxl.py <directory> <output directory> [-m merged.tsv|merged.sqlite|merged.parquet] [-j jobs]
+#                       [-e export.sqlite|export.parquet]
 
+import argparse
+import codecs
+import concurrent.futures
+import glob
+import heapq
+import io
+import itertools
+import mmap
+import operator
+import os
+import re
+import struct
 import sys
+import tempfile
+import warnings
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import export
+
+EXPORT_COLUMNS = [('uid_id', int), ('type', int), ('uid', str), ('text', str)]
+
+
+class NTXL:
+    MAGIC = b'NTXL\x05\x01'
+    # magic, language, const, file start/end, uval, entry table start/end
+    HEADER_FORMAT = '<6s2sIIIIII'
+    # uid offset, string offset, and a third value that isn't used
+    ENTRY_FORMAT = '<II4x'
+    ENTRY_SIZE = 12
+    # uid records are (id, length, ascii), string records (type, length, utf-16le)
+    RECORD_FORMAT = '<HH'
+    UNESCAPES = {'\\': '\\', 'r': '\r', 'n': '\n', 't': '\t'}
+    ESCAPE_SEQUENCE = re.compile(r'\\(.)')
+
+    def __init__(self, data):
+        self.data = data
+        self.view = memoryview(data)
+        if self.view[0:6] != self.MAGIC:
+            raise ValueError('Not a NTXL file.')
+        (_, lang, self.const, self.file_start, self.file_end,
+         self.uval, self.start, self.end) = struct.unpack_from(self.HEADER_FORMAT, self.view)
+        self.lang = lang.decode('ascii')
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return cls(b'')
+            return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def close(self):
+        self.view.release()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(range(self.start, self.end, self.ENTRY_SIZE))
+
+    def iter_entries(self):
+        # (uid offset, string offset) pairs
+        size = len(self) * self.ENTRY_SIZE
+        if self.start + size > len(self.view):
+            raise ValueError('entry table runs past the end of the file')
+        return struct.iter_unpack(self.ENTRY_FORMAT, self.view[self.start:self.start + size])
+
+    def read_entry(self, uid_index, str_index):
+        # The codec functions are called directly: going through str() or .decode() looks the
+        # codec up by name every time, which costs more than decoding these short strings.
+        view = self.view
+
+        # read string identifier
+        uid_id, uid_length = struct.unpack_from(self.RECORD_FORMAT, view, uid_index)
+        uid_value = codecs.ascii_decode(view[uid_index + 4:uid_index + 4 + uid_length])[0]
+
+        # read string
+        str_type, str_length = struct.unpack_from(self.RECORD_FORMAT, view, str_index)  # 2 is a normal string
+        # strings are null-terminated utf-16le
+        raw = view[str_index + 4:str_index + 4 + str_length]
+        try:
+            str_value = codecs.utf_16_le_decode(raw, 'strict', True)[0]
+        except UnicodeDecodeError:
+            warnings.warn(f'Failed to decode string {uid_value} ({uid_id:#x}) at {str_index:#x}, '
+                          f'falling back to hex', RuntimeWarning)
+            str_value = raw.hex()
+        # without a terminator this drops the last character, as it always has
+        str_value = str_value[0:str_value.find('\x00')]
+        return uid_id, str_type, uid_value, str_value
+
+    def __iter__(self):
+        # (uid id, string type, uid, text) for every entry
+        for uid_index, str_index in self.iter_entries():
+            yield self.read_entry(uid_index, str_index)
+
+    @staticmethod
+    def format_row(row):
+        uid_id, str_type, uid_value, str_value = row
+        str_value = str_value.replace('\\', '\\\\').replace('\r', '\\r').replace('\n', '\\n').replace('\t', '\\t')
+        return f'{uid_id:#06x}\t{str_type}\t{uid_value}\t{str_value}\n'
+
+    def dump(self, f):
+        f.writelines(map(self.format_row, self))
+
+    @classmethod
+    def parse_row(cls, line):
+        uid_id, str_type, uid_value, str_value = line.split('\t', 3)
+        return int(uid_id, 16), int(str_type), uid_value, cls.unescape(str_value)
+
+    @classmethod
+    def unescape(cls, s):
+        if '\\' not in s:
+            return s
+        return cls.ESCAPE_SEQUENCE.sub(lambda m: cls.UNESCAPES.get(m[1], m[0]), s)
+
+    @classmethod
+    def load(cls, f):
+        # rows as written by dump
+        lines = f.read().split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        return [cls.parse_row(line) for line in lines]
+
+    def pack(self, rows):
+        # Rebuilds this file around new rows: the header, anything before the entry table and
+        # each entry's unused third value are kept, and the records follow the new table.
+        # Identical uid and string records are stored once and share an offset.
+        extras = [extra for extra, in struct.iter_unpack('<8xI', self.view[self.start:self.start + len(self) * 12])]
+        entries = bytearray()
+        records = bytearray()
+        base = self.start + len(rows) * self.ENTRY_SIZE
+        offsets = {}
+
+        def record(key, payload):
+            offset = offsets.get(key)
+            if offset is None:
+                # keep the u16 fields aligned
+                records.extend(bytes(-len(records) % 4))
+                offset = offsets[key] = base + len(records)
+                records.extend(payload)
+            return offset
+
+        for i, (uid_id, str_type, uid_value, str_value) in enumerate(rows):
+            uid = uid_value.encode('ascii')
+            text = (str_value + '\x00').encode('utf-16-le')
+            uid_offset = record((0, uid_id, uid), struct.pack(self.RECORD_FORMAT, uid_id, len(uid)) + uid)
+            str_offset = record((1, str_type, text), struct.pack(self.RECORD_FORMAT, str_type, len(text)) + text)
+            entries.extend(struct.pack('<III', uid_offset, str_offset, extras[i] if i < len(extras) else 0))
+
+        size = base + len(records)
+        # the header's end offsets only move if they pointed at the end of the original file
+        file_end = size if self.file_end == len(self.view) else self.file_end
+        end = base if self.end == self.start + len(self) * self.ENTRY_SIZE else self.end
+        header = struct.pack(self.HEADER_FORMAT, self.MAGIC, self.lang.encode('ascii'), self.const,
+                             self.file_start, file_end, self.uval, self.start, end)
+        return b''.join([header, self.view[len(header):self.start], entries, records])
+
+
+def dump(src, dst=None, verbose=False, sorted_dst=None, rows=False):
+    # dst defaults to the NTXL name with its language; inside a directory it keeps the file's own name.
+    # sorted_dst also gets (uid, text) rows ordered by uid, ready for merge_languages.
+    # With rows, the rows for common.export are returned too, from the same read.
+    with NTXL.open(src) as ntxl:
+        if verbose:
+            print('lang', ntxl.lang)
+            print('const', ntxl.const)
+            print('file_start, file_end', [hex(ntxl.file_start), hex(ntxl.file_end)])
+            print('uval, start, end', [hex(i) for i in [ntxl.uval, ntxl.start, ntxl.end]])
+        if dst is None:
+            dst = src[:-8] + ntxl.lang + '.txt'
+        elif os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src).removesuffix('.ntxl') + '.txt')
+        if sorted_dst is None and not rows:
+            with open(dst, 'w', encoding='utf-8') as out:
+                ntxl.dump(out)
+            return ntxl.lang, dst
+
+        # the entries (and their lines, for sorted_dst) are only held when they are needed again
+        entries = list(ntxl)
+        lines = list(map(ntxl.format_row, entries)) if sorted_dst is not None else map(ntxl.format_row, entries)
+        with open(dst, 'w', encoding='utf-8') as out:
+            out.writelines(lines)
+        if sorted_dst is not None:
+            # sorting on the uid alone is stable, so a uid used more than once keeps its file order
+            by_uid = sorted((line.split('\t', 3)[2:] for line in lines), key=operator.itemgetter(0))
+            with open(sorted_dst, 'w', encoding='utf-8') as out:
+                out.writelines(uid + '\t' + text for uid, text in by_uid)
+        if rows:
+            return ntxl.lang, dst, entries
+        return ntxl.lang, dst
+
+
+def export_rows(src):
+    # (uid id, string type, uid, text) rows, unescaped, for common.export
+    with NTXL.open(src) as ntxl:
+        return list(ntxl)
+
+
+def dump_dir(src, dst, merged=None, jobs=0, export_path=None):
+    # Dumps every NTXL in a directory across a process pool, then optionally joins them on
+    # uid into one table and exports them to one SQLite or Parquet file.
+    # Returns the number of files that failed.
+    os.makedirs(dst, exist_ok=True)
+    sources = sorted(glob.glob(os.path.join(src, '*.ntxl')))
+    failed = 0
+    langs = {}
+
+    with tempfile.TemporaryDirectory() as tmp, export.open_exporter(export_path) as exporter:
+        sorted_paths = {src_fn: os.path.join(tmp, f'{i}.txt') for i, src_fn in enumerate(sources)}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs or None) as executor:
+            futures = {executor.submit(dump, src_fn, dst, sorted_dst=sorted_paths[src_fn] if merged else None,
+                                       rows=exporter is not None): src_fn
+                       for src_fn in sources}
+            for future in concurrent.futures.as_completed(futures):
+                src_fn = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    failed += 1
+                    print(f'{src_fn}: {type(e).__name__}: {e}', file=sys.stderr)
+                    continue
+                if exporter is None:
+                    langs[src_fn], dst_fn = result
+                    print(dst_fn)
+                    continue
+                langs[src_fn], dst_fn, rows = result
+                print(dst_fn)
+                failed += export.write_file(exporter, 'ntxl', EXPORT_COLUMNS, src_fn, rows, index=['uid'])
+
+        if merged:
+            done = [src_fn for src_fn in sources if src_fn in langs]
+            # columns are languages, or file names where two files share a language
+            columns = [langs[src_fn] if list(langs.values()).count(langs[src_fn]) == 1
+                       else os.path.basename(src_fn)[:-5] for src_fn in done]
+            merge_languages([sorted_paths[src_fn] for src_fn in done], columns, merged)
+            print(merged)
+
+    if export_path:
+        print(export_path)
+    return failed
+
+
+def iter_sorted(path, column):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            uid, text = line.rstrip('\n').split('\t', 1)
+            yield uid, column, text
+
+
+def iter_merged(paths, columns):
+    # Streams a k-way merge of the uid-sorted files, so only one uid's rows are held at a time.
+    # A uid used n times in a language fills n rows, matched up in file order.
+    streams = [iter_sorted(path, column) for column, path in enumerate(paths)]
+    merged = heapq.merge(*streams, key=lambda row: row[0])
+    for uid, group in itertools.groupby(merged, key=lambda row: row[0]):
+        texts = [[] for _ in columns]
+        for _, column, text in group:
+            texts[column].append(text)
+        for n in range(max(map(len, texts))):
+            yield [uid] + [column[n] if n < len(column) else None for column in texts]
+
+
+def merge_languages(paths, columns, dst):
+    # Joins the languages on uid into a TSV, or an "ntxl_merged" table (with the text unescaped)
+    # when dst is a SQLite or Parquet file. The table is replaced, but the rest of a database
+    # is kept, so it can also hold the per-file "ntxl" table -e writes.
+    rows = iter_merged(paths, columns)
+    if export.is_export(dst):
+        rows = ([uid] + [text if text is None else NTXL.unescape(text) for text in texts] for uid, *texts in rows)
+        with export.Exporter(dst) as exporter:
+            exporter.write('ntxl_merged', [('uid', str)] + [(column, str) for column in columns], rows, index=['uid'])
+    else:
+        with open(dst, 'w', encoding='utf-8') as out:
+            out.write('\t'.join(['uid'] + columns) + '\n')
+            out.writelines('\t'.join(text or '' for text in row) + '\n' for row in rows)
+
+
+def pack(template, src, dst, verify=False):
+    with open(src, 'r', encoding='utf-8') as f:
+        text = f.read()
+    rows = NTXL.load(io.StringIO(text))
+    with NTXL.open(template) as ntxl:
+        data = ntxl.pack(rows)
+    with open(dst, 'wb') as out:
+        out.write(data)
+
+    if verify:
+        # Verify the written file dumps back to exactly the text it was packed from
+        with io.StringIO() as buf:
+            NTXL(data).dump(buf)
+            dumped = buf.getvalue()
+        if dumped != text:
+            lines = zip(dumped.split('\n'), text.split('\n'))
+            line = next((i for i, (a, b) in enumerate(lines, 1) if a != b), 'end')
+            raise RuntimeError(f'written file does not match the text it was packed from (first difference at line {line})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parses NTXL files and outputs a txt file, or packs one back.')
+    parser.add_argument('src', help='NTXL file, or txt file when packing')
+    parser.add_argument('dst', nargs='?', help='Output file (defaults to the NTXL name with its language)')
+    parser.add_argument('-p', '--pack', metavar='ORIGINAL', help='pack src into dst, using ORIGINAL for the header layout')
+    parser.add_argument('-v', '--verify', help='verify the packed file dumps back to the same text', action='store_true')
+    parser.add_argument('-m', '--merged', help='with a directory, also join every language on uid into this TSV, .sqlite or .parquet file')
+    parser.add_argument('-j', '--jobs', help='number of files to dump in parallel (0 for one per CPU)', type=int, default=0)
+    parser.add_argument('-e', '--export', help='also write the rows to this .sqlite/.db or .parquet file')
+    args = parser.parse_args()
 
-def read_val(data, index, length=4):
-    # print(data[index:index+length])
-    return int.from_bytes(data[index:index+length], byteorder='little', signed=False)
-
-def read_string_table(data, start, end):
-    string_table = []
-    for i in range(start, end, 12):
-        uid_index = read_val(data, i, 4)
-        str_index = read_val(data, i + 4, 4)
-        string_table.append(get_string(data, uid_index, str_index))
-    return string_table
-    
-def get_string(data, uid_index, str_index):
-    # read string identifier
-    uid_id = read_val(data, uid_index, 2)
-    uid_length = read_val(data, uid_index + 2, 2)
-    uid_value = data[uid_index + 4:uid_index + 4 + uid_length].decode('ascii')
-    
-    # read string
-    str_type = read_val(data, str_index, 2) # 2 is a normal string
-    str_length = read_val(data, str_index + 2, 2)
-    # strings are null-terminated utf-16le
-    str_value = data[str_index + 4:str_index + 4 + str_length]
     try:
-        str_value = str_value.decode('utf-16-le')
-    except:
-        print("Failed to encode:")
-        print(hex(uid_id), uid_value, hex(str_index), str_type, str_value)
-        str_value = str_value.hex() #fallback to hex
-    str_value = str_value[0:str_value.find('\x00')]
-    str_value = str_value.replace('\\', '\\\\').replace('\r', '\\r').replace('\n', '\\n').replace('\t', '\\t')
-    
-    # return ("{0:#06x}".format(uid_id), uid_value, "{0:#06x}".format(str_type), str_value)
-    return ("{0:#06x}".format(uid_id), str(str_type), uid_value, str_value)
-
-with open(sys.argv[1], 'rb') as file:
-    data = file.read()
-    
-    # Check file header
-    if (data[0:6] != b'NTXL\x05\x01'):
-        print('Not a NTXL file.')
-        sys.exit()
-    
-    lang = data[6:8].decode('ascii')
-    print('lang', lang)
-    
-    const = read_val(data, 0x08, 4)
-    print('const', const)
-    
-    file_start, file_end = read_val(data, 0x0C, 4), read_val(data, 0x10, 4)
-    print('file_start, file_end', [hex(file_start), hex(file_end)])
-    
-    uval, start, end = (read_val(data, i, 4) for i in range(0x14, 0x20, 4))
-    print('uval, start, end', [hex(i) for i in [uval, start, end]])
-    
-    string_table = read_string_table(data, start, end)
-    # print(string_table)
-    output = ''
-    for a in string_table:
-        output += '\t'.join(a) + '\n'
-    with open((sys.argv[1])[:-8] + lang + '.txt', 'w', encoding='utf-8') as out:
-        out.write(output)
\ No newline at end of file
+        if os.path.isdir(args.src):
+            if args.dst is None:
+                parser.error('a directory needs an output directory')
+            if dump_dir(args.src, args.dst, args.merged, args.jobs, args.export):
+                sys.exit(1)
+        elif args.pack:
+            if args.dst is None:
+                parser.error('packing needs an output file')
+            pack(args.pack, args.src, args.dst, verify=args.verify)
+        else:
+            dump(args.src, args.dst, verbose=True)
+            if args.export:
+                if export.export_files(args.export, 'ntxl', EXPORT_COLUMNS, export_rows, [args.src], index=['uid']):
+                    sys.exit(1)
+                print(args.export)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
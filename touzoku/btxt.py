@@ -1,17 +1,40 @@
 import argparse
+import concurrent.futures
+import functools
 import glob
+import hashlib
 import io
+import json
+import mmap
 import os
 import re
+import shutil
 import struct
+import sys
+import tempfile
 import warnings
-from typing import BinaryIO, TextIO, Self
+from typing import BinaryIO, Iterable, TextIO, Self
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import export
+
+EXPORT_COLUMNS = [('label', str), ('text', str)]
 
 
 class BTXT:
     HEADER_FORMAT = '<IIHH'
     METADATA_FORMAT = '<IBBBB'
     CONTROL = '\u1B01\u1B02\u1C01\u1C02\u1700\u1701\u1800\u1900'
+    CONTROL_CHAR = re.compile(f'[{CONTROL}]')
+    LABEL_END = re.compile(b'\x00')
+    TEXT_END = re.compile(b'\x00\x00')
+    ESCAPES = ({'\\': '\\\\', '\r': '\\r', '\n': '\\n', '\t': '\\t'}
+               | {c: f'\\x{ord(c):04X}' for c in CONTROL})
+    ESCAPE_CHAR = re.compile(f'[{re.escape("".join(ESCAPES))}]')
+    UNESCAPES = {'r': '\r', 'n': '\n', 't': '\t'}
+    ESCAPE_SEQUENCE = re.compile(r'\\(?:x(.{0,4})|(.)|\Z)', re.DOTALL)
+    TEXT_PADDING = {0: b'\x00' * 4, 2: b'\x00' * 6}
+    SPOOL_SIZE = 16 * 1024 * 1024
 
     def __init__(self, magic: int, labels: list[str], text: list[str], *,
                  metadata: list[tuple] = None, label_offsets: list[int] = None, text_offsets: list[int] = None):
@@ -33,129 +56,202 @@ class BTXT:
     @classmethod
     def read(cls, f: BinaryIO) -> Self:
         """Read and parse the data from a binary file."""
-        h_00, magic, count, count2 = struct.unpack(cls.HEADER_FORMAT, f.read(struct.calcsize(cls.HEADER_FORMAT)))
+        try:
+            fileno = f.fileno()
+        except (AttributeError, OSError):
+            return cls.from_buffer(f.read())
+
+        start = f.tell()
+        if os.fstat(fileno).st_size <= start:
+            return cls.from_buffer(f.read())
+        with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as data:
+            msg = cls.from_buffer(data, start)
+        f.seek(0, os.SEEK_END)
+        return msg
+
+    @classmethod
+    def from_buffer(cls, data, start: int = 0) -> Self:
+        """Parse the data from a bytes-like object (bytes, memoryview, mmap, ...) without copying it."""
+        with memoryview(data) as view:
+            magic, metadata, label_offsets, text_offsets, pos = cls.read_tables(view, start)
+
+            label_spans = [cls._find_span(view, pos + offset, cls.LABEL_END) for offset in label_offsets]
+            labels = cls._decode_pool(view, label_spans, 'ascii', 1)
+
+            text_spans = [cls._find_span(view, pos + offset, cls.TEXT_END) for offset in text_offsets]
+            text = cls._decode_pool(view, text_spans, 'utf-16-le', 2)
+            for i, s in enumerate(text):  # type: int, str
+                if metadata[i] != (calc := cls.calculate_metadata(s, i)):
+                    warnings.warn(f'Expected metadata of {calc!r} but found {metadata[i]!r} instead for string {s!r}', RuntimeWarning)
+
+            end = text_spans[-1][2] if text_spans else pos
+            padding = b'\x00\x00\x00\x00' if end % 4 == 0 else b'\x00\x00'
+            if view[end:] != padding:
+                warnings.warn('Found unexpected padding at end of file', RuntimeWarning)
+
+        return cls(magic, labels, text,
+                   metadata=metadata, label_offsets=label_offsets, text_offsets=text_offsets)
+
+    @classmethod
+    def read_tables(cls, view: memoryview, start: int = 0) -> tuple[int, list[tuple], list[int], list[int], int]:
+        """Parse the header, metadata and offset tables, returning them along with the start of the string pools."""
+        h_00, magic, count, count2 = struct.unpack_from(cls.HEADER_FORMAT, view, start)
         if h_00 != 0:
             raise ValueError('invalid header')
         if count != count2:
             raise ValueError('counts not equal')
 
-        metadata = [struct.unpack(cls.METADATA_FORMAT, f.read(8)) for _ in range(count)]
-        label_offsets: list[int] = list(struct.unpack(f'<{count}I', f.read(4 * count)))
-        text_offsets: list[int] = list(struct.unpack(f'<{count}I', f.read(4 * count)))
-
-        labels = []
-        pos = f.tell()
-        for offset in label_offsets:
-            f.seek(pos + offset, os.SEEK_SET)
-            buf = bytearray()
-            while value := f.read(1):
-                if value == b'\x00':
-                    break
-                buf += value
-            s = buf.decode('ascii')
-            labels.append(s)
-
-        text = []
-        for i, offset in enumerate(text_offsets):  # type: int, int
-            f.seek(pos + offset, os.SEEK_SET)
-            buf = bytearray()
-            while value := f.read(2):
-                if value == b'\x00\x00':
-                    break
-                buf += value
-            s = buf.decode('utf-16-le')
-            if metadata[i] != (calc := cls.calculate_metadata(s, i)):
-                warnings.warn(f'Expected metadata of {calc!r} but found {metadata[i]!r} instead for string {s!r}', RuntimeWarning)
-            text.append(s)
-
-        padding = b'\x00\x00\x00\x00' if f.tell() % 4 == 0 else b'\x00\x00'
-        if f.read() != padding:
-            warnings.warn('Found unexpected padding at end of file', RuntimeWarning)
+        metadata_start = start + struct.calcsize(cls.HEADER_FORMAT)
+        metadata_end = metadata_start + struct.calcsize(cls.METADATA_FORMAT) * count
+        metadata = list(struct.iter_unpack(cls.METADATA_FORMAT, view[metadata_start:metadata_end]))
+        label_offsets: list[int] = list(struct.unpack_from(f'<{count}I', view, metadata_end))
+        text_offsets: list[int] = list(struct.unpack_from(f'<{count}I', view, metadata_end + 4 * count))
+        return magic, metadata, label_offsets, text_offsets, metadata_end + 8 * count
 
-        return cls(magic, labels, text,
-                   metadata=metadata, label_offsets=label_offsets, text_offsets=text_offsets)
+    @staticmethod
+    def _find_span(view: memoryview, offset: int, terminator: re.Pattern) -> tuple[int, int, int]:
+        """Locate a null-terminated string, returning its start, the end of its contents, and the end of its terminator."""
+        width = len(terminator.pattern)
+        match = terminator.search(view, offset)
+        while match is not None and (match.start() - offset) % width != 0:
+            match = terminator.search(view, match.start() + 1)
+        if match is None:
+            return offset, len(view), len(view)  # unterminated, so it runs to the end of the file
+        return offset, match.start(), match.end()
+
+    @staticmethod
+    def _decode_pool(view: memoryview, spans: list[tuple[int, int, int]], encoding: str, width: int) -> list[str]:
+        """Decode every string in a pool with a single decode call, falling back to one call per string."""
+        if not spans:
+            return []
+        starts, ends, _ = zip(*spans)
+        lo = min(starts)
+        hi = max(ends)
+        if all((start - lo) % width == 0 for start in starts):
+            try:
+                pool = str(view[lo:hi - (hi - lo) % width], encoding)
+            except UnicodeDecodeError:
+                pass
+            else:
+                if len(pool) * width == hi - lo:
+                    return [pool[(a - lo) // width:(b - lo) // width] for a, b, _ in spans]
+        return [str(view[a:b], encoding) for a, b, _ in spans]
 
     def write(self, f: BinaryIO):
         """Write the data to a binary file."""
-        if self.metadata is None:
-            metadata = [self.calculate_metadata(text, index) for index, text in enumerate(self.text)]
-        else:
-            metadata = self.metadata
-
         if self.label_offsets is None or self.text_offsets is None:
-            label_offsets = []
-            text_offsets = []
-            offset = 0
-            for s in self.labels:
-                label_offsets.append(offset)
-                offset += len(s) + 1
-                if offset % 4 != 0:
-                    offset += 4 - (offset % 4)
-            for s in self.text:
-                text_offsets.append(offset)
-                offset += len(s) * 2 + 2
-                offset += 4 if offset % 4 == 0 else 2
-        else:
-            label_offsets = self.label_offsets
-            text_offsets = self.text_offsets
-
-        f.write(struct.pack(self.HEADER_FORMAT, 0, self.magic, len(self.labels), len(self.text)))
-        for v in metadata:
-            f.write(struct.pack(self.METADATA_FORMAT, *v))
-        f.write(struct.pack(f'<{len(label_offsets)}I', *label_offsets))
-        f.write(struct.pack(f'<{len(text_offsets)}I', *text_offsets))
-
-        pos = f.tell()
-        for offset, label in zip(label_offsets, self.labels):  # type: int, str
-            if (cur := f.tell() - pos) < offset:
-                f.write(b'\x00' * (offset - cur))
-            f.write(label.encode('ascii'))
-            f.write(b'\x00')
-
-        for offset, text in zip(text_offsets, self.text):  # type: int, str
-            if (cur := f.tell() - pos) < offset:
-                f.write(b'\x00' * (offset - cur))
-            f.write(text.encode('utf-16le'))
-            f.write(b'\x00\x00')
-
-        padding = b'\x00\x00\x00\x00' if f.tell() % 4 == 0 else b'\x00\x00'
-        f.write(padding)
+            self.write_pairs(f, self.magic, zip(self.labels, self.text), metadata=self.metadata)
+            return
+
+        # Keep the original layout, including any gaps between strings
+        count = len(self.text)
+        buf = bytearray(struct.pack(self.HEADER_FORMAT, 0, self.magic, len(self.labels), count))
+        for index, text in enumerate(self.text):
+            metadata = self.calculate_metadata(text, index) if self.metadata is None else self.metadata[index]
+            buf += struct.pack(self.METADATA_FORMAT, *metadata)
+        buf += struct.pack(f'<{len(self.label_offsets)}I', *self.label_offsets)
+        buf += struct.pack(f'<{len(self.text_offsets)}I', *self.text_offsets)
+
+        pos = len(buf)
+        for offset, label in zip(self.label_offsets, self.labels):  # type: int, str
+            if (cur := len(buf) - pos) < offset:
+                buf += bytes(offset - cur)
+            buf += label.encode('ascii')
+            buf += b'\x00'
+
+        for offset, text in zip(self.text_offsets, self.text):  # type: int, str
+            if (cur := len(buf) - pos) < offset:
+                buf += bytes(offset - cur)
+            buf += text.encode('utf-16le')
+            buf += b'\x00\x00'
+
+        buf += b'\x00\x00\x00\x00' if len(buf) % 4 == 0 else b'\x00\x00'
+        f.write(buf)
+
+    @classmethod
+    def write_pairs(cls, f: BinaryIO, magic: int, pairs: Iterable[tuple[str, str]], *, metadata: list[tuple] = None):
+        """Write (label, text) pairs to a binary file in a single pass, so that they can be generated on the fly.
+
+        Only the tables and the label pool are kept in memory; the text pool is spilled to a temporary file whenever
+        more than SPOOL_SIZE bytes of it are pending.
+        """
+        entries = bytearray()
+        label_offsets: list[int] = []
+        text_offsets: list[int] = []
+        labels = bytearray()
+        text_chunks: list[bytes] = []
+        text_size = 0
+        pending = 0
+        spool = None
+        try:
+            for index, (label, text) in enumerate(pairs):  # type: int, (str, str)
+                entries += struct.pack(cls.METADATA_FORMAT, *(
+                    cls.calculate_metadata(text, index) if metadata is None else metadata[index]))
+
+                label_offsets.append(len(labels))
+                labels += label.encode('ascii')
+                labels += bytes(4 - len(labels) % 4)  # null terminator and alignment
+
+                text_offsets.append(text_size)
+                data = text.encode('utf-16le')
+                padding = cls.TEXT_PADDING[len(data) % 4]  # null terminator and alignment
+                text_chunks += (data, padding)
+                text_size += len(data) + len(padding)
+                pending += len(data) + len(padding)
+                if pending > cls.SPOOL_SIZE:
+                    spool = spool or tempfile.TemporaryFile()
+                    spool.writelines(text_chunks)
+                    text_chunks.clear()
+                    pending = 0
+
+            count = len(text_offsets)
+            if count == 0:
+                text_chunks.append(b'\x00\x00\x00\x00')
+            text_offsets = [offset + len(labels) for offset in text_offsets]
+
+            header = (
+                struct.pack(cls.HEADER_FORMAT, 0, magic, count, count),
+                entries,
+                struct.pack(f'<{count}I', *label_offsets),
+                struct.pack(f'<{count}I', *text_offsets),
+                labels,
+            )
+            if spool is None:
+                f.writelines(header + tuple(text_chunks))
+            else:
+                spool.writelines(text_chunks)
+                spool.seek(0)
+                f.writelines(header)
+                shutil.copyfileobj(spool, f)
+        finally:
+            if spool is not None:
+                spool.close()
 
     @classmethod
     def escape(cls, s: str):
         """Escape the string so that it can be dumped."""
-        s = (s.replace('\\', '\\\\')
-            .replace('\r', '\\r')
-            .replace('\n', '\\n')
-            .replace('\t', '\\t')
-             )
-        s = re.sub(f'[{cls.CONTROL}]', lambda match: f'\\x{ord(match.group(0)[0]):04X}', s)
-        return s
+        return cls.ESCAPE_CHAR.sub(lambda match: cls.ESCAPES[match.group()], s)
 
     @classmethod
     def unescape(cls, s: str):
         """Unescape the string read from a dump."""
-        out: list[str] = []
-        i = 0
-        while i < len(s):
-            c = s[i]; i += 1
-            if c != '\\':
-                out.append(c)
-            else:  # escape sequence
-                c = s[i]; i += 1
-                match c:
-                    case 'r': out.append('\r')
-                    case 'n': out.append('\n')
-                    case 't': out.append('\t')
-                    case 'x': out.append(chr(int(s[i:i+4], 16))); i += 4
-                    case _: out.append(c)
-        return ''.join(out)
+        if '\\' not in s:
+            return s
+        return cls.ESCAPE_SEQUENCE.sub(cls._unescape_sequence, s)
+
+    @classmethod
+    def _unescape_sequence(cls, match: re.Match) -> str:
+        if (code := match.group(1)) is not None:
+            return chr(int(code, 16))
+        if (c := match.group(2)) is not None:
+            return cls.UNESCAPES.get(c, c)
+        raise ValueError('incomplete escape sequence at end of string')
 
     @classmethod
     def calculate_metadata(cls, s: str, index: int):
         """Calculates the stored metadata for the string."""
-        lines = re.sub(f'[{cls.CONTROL}]', '', s).split('\n')  # \r is not counted as part of the line break
-        width = max(len(line) for line in lines)
+        lines = cls.CONTROL_CHAR.sub('', s).split('\n')  # \r is not counted as part of the line break
+        width = max(map(len, lines))
         height = len(lines)
         length = n if (n := len(s)) % 2 == 0 else (n + 1)  # this includes the control characters
         return 1, width, height, length, index % 256
@@ -163,9 +259,7 @@ class BTXT:
     def dump(self, f: TextIO):
         """Dump to file as plain text."""
         f.write(f'{self.magic:08X}\n')
-        for i, (label, text) in enumerate(zip(self.labels, self.text)):  # type: tuple, str, str
-            f.write('\t'.join((label, self.escape(text))))
-            f.write('\n')
+        f.writelines(f'{label}\t{self.escape(text)}\n' for label, text in zip(self.labels, self.text))
 
     @classmethod
     def load(cls, f: TextIO):
@@ -181,27 +275,129 @@ class BTXT:
         return cls(magic, labels, text)
 
 
-def unpack(src: str, dst: str, *, verify: bool = False):
+
+class LazyBTXT:
+    """Read-only view of a BTXT file that only decodes the strings that are accessed."""
+
+    def __init__(self, data, start: int = 0, *, cache_size: int = 256):
+        self._data = data
+        self._view = memoryview(data)
+        self._start = start
+        self.magic, self.metadata, self.label_offsets, self.text_offsets, self._pos = BTXT.read_tables(self._view, start)
+        self._index: dict[str, int] | None = None
+
+        self.get_label = functools.lru_cache(maxsize=cache_size)(self._read_label)
+        self.get_text = functools.lru_cache(maxsize=cache_size)(self._read_text)
+
+    @classmethod
+    def open(cls, path: str, **kwargs) -> Self:
+        """Map a BTXT file into memory and open it for random access."""
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(b'', **kwargs)
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(data, **kwargs)
+        except BaseException:
+            data.close()
+            raise
+
+    def close(self):
+        """Release the underlying buffer, closing it if it was mapped by `open`."""
+        self.get_label.cache_clear()
+        self.get_text.cache_clear()
+        self._view.release()
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.text_offsets)
+
+    def __getitem__(self, key: int | str) -> str:
+        """Get the text for a string, by index or by label."""
+        if isinstance(key, str):
+            key = self.index[key]
+        return self.get_text(range(len(self))[key])
+
+    def _read_label(self, index: int) -> str:
+        start, end, _ = BTXT._find_span(self._view, self._pos + self.label_offsets[index], BTXT.LABEL_END)
+        return str(self._view[start:end], 'ascii')
+
+    def _read_text(self, index: int) -> str:
+        start, end, _ = BTXT._find_span(self._view, self._pos + self.text_offsets[index], BTXT.TEXT_END)
+        return str(self._view[start:end], 'utf-16-le')
+
+    @property
+    def index(self) -> dict[str, int]:
+        """Mapping of each label to the index of its first occurrence, built on first use."""
+        if self._index is None:
+            self._index = {}
+            for i in range(len(self)):
+                self._index.setdefault(self._read_label(i), i)
+        return self._index
+
+    def to_btxt(self) -> BTXT:
+        """Decode every string and return a fully loaded BTXT."""
+        return BTXT.from_buffer(self._view, self._start)
+
+
+def unpack(src: str, dst: str, *, verify: bool = False) -> BTXT:
+    """Dump a BTXT file to text, returning what was read."""
+    if not verify:
+        with open(src, 'rb') as f:
+            msg = BTXT.read(f)
+        with open(dst, 'w', encoding='utf-8') as out:
+            msg.dump(out)
+        return msg
+
+    # Keep the original file and the dumped text in memory, so that verifying them does not go back to the disk
     with open(src, 'rb') as f:
-        msg = BTXT.read(f)
+        original = f.read()
+    msg = BTXT.from_buffer(original)
+    with io.StringIO() as buf:
+        msg.dump(buf)
+        text = buf.getvalue()
     with open(dst, 'w', encoding='utf-8') as out:
-        msg.dump(out)
-
-    if verify:
-        # Verify loading the dumped text is equivalent to the file read
-        with open(dst, 'r', encoding='utf-8') as out:
-            dumped = BTXT.load(out)
-        if msg != dumped:
-            raise RuntimeError('dumped text does not match the file read')
-
-        # Verify written file is equivalent to the file read
-        with io.BytesIO() as edited:
-            dumped.write(edited)
-            out = edited.getvalue()
-        with open(src, 'rb') as f:
-            original = f.read()
-        if original != out:
-            raise RuntimeError('written file does not match the file read')
+        out.write(text)
+
+    # Verify loading the dumped text is equivalent to the file read
+    with io.StringIO(text) as buf:
+        dumped = BTXT.load(buf)
+    if msg != dumped:
+        raise RuntimeError('dumped text does not match the file read')
+
+    # Verify written file is equivalent to the file read
+    with io.BytesIO() as edited:
+        dumped.write(edited)
+        with edited.getbuffer() as out:
+            offset = first_difference(original, out)
+    if offset is not None:
+        raise RuntimeError(f'written file does not match the file read (first difference at offset 0x{offset:X})')
+    return msg
+
+
+def export_rows(src: str) -> list[tuple[str, str]]:
+    """(label, text) rows for common.export, with the text unescaped."""
+    with open(src, 'rb') as f:
+        msg = BTXT.read(f)
+    return list(zip(msg.labels, msg.text))
+
+
+def first_difference(a: bytes, b: bytes, chunk_size: int = 0x10000) -> int | None:
+    """Compare two buffers chunk by chunk, returning the offset of the first differing byte, if any."""
+    a, b = memoryview(a), memoryview(b)
+    for start in range(0, max(len(a), len(b)), chunk_size):
+        chunk_a, chunk_b = a[start:start + chunk_size], b[start:start + chunk_size]
+        if chunk_a != chunk_b:
+            return start + next((i for i, (x, y) in enumerate(zip(chunk_a, chunk_b)) if x != y),
+                                min(len(chunk_a), len(chunk_b)))
+    return None
 
 
 def pack(src: str, dst: str):
@@ -211,27 +407,169 @@ def pack(src: str, dst: str):
         msg.write(out)
 
 
+def convert(action: str, src: str, dst: str, *, verify: bool = False, digest: bool = False, rows: bool = False):
+    """Convert a single file, returning the hash of the output if requested.
+
+    With rows, when unpacking, returns (hash, the (label, text) rows for common.export) instead,
+    so the file need not be read again to export it."""
+    if action in ['u', 'unpack']:
+        msg = unpack(src, dst, verify=verify)
+    else:
+        msg = None
+        pack(src, dst)
+    output_hash = file_hash(dst) if digest else None
+    if rows and msg is not None:
+        return output_hash, list(zip(msg.labels, msg.text))
+    return output_hash
+
+
+def file_hash(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+@functools.cache
+def tool_version() -> str:
+    """Identify this version of the script, so that files converted by another version are rebuilt."""
+    return file_hash(__file__)[:16]
+
+
+class Manifest:
+    """Sidecar file recording the source hash, output hash and tool version of each converted file."""
+    FILENAME = '.btxt_manifest.json'
+
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries: dict[str, dict] = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def is_current(self, key: str, source_hash: str, dst: str, *, verify: bool = False) -> bool:
+        """Check whether the output is up-to-date for the source and has not been modified since it was written."""
+        entry = self.entries.get(key)
+        if entry is None or entry['source'] != source_hash or entry['version'] != tool_version():
+            return False
+        if verify and not entry['verified']:
+            return False
+        try:
+            return file_hash(dst) == entry['output']
+        except FileNotFoundError:
+            return False
+
+    def update(self, key: str, source_hash: str, output_hash: str, *, verified: bool = False):
+        self.entries[key] = {'source': source_hash, 'output': output_hash, 'version': tool_version(), 'verified': verified}
+
+    def discard(self, key: str):
+        self.entries.pop(key, None)
+
+    def save(self):
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def convert_all(action: str, tasks: list[tuple[str, str]], *, verify: bool = False, digest: bool = False,
+                rows: bool = False, jobs: int = 1):
+    """Convert each (src, dst) pair, yielding (src, dst, what convert returned, exception) as each file finishes."""
+    if jobs == 1:
+        for src_fn, dst_fn in tasks:
+            try:
+                yield src_fn, dst_fn, convert(action, src_fn, dst_fn, verify=verify, digest=digest, rows=rows), None
+            except Exception as e:
+                yield src_fn, dst_fn, None, e
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs or None) as executor:
+        futures = {executor.submit(convert, action, src_fn, dst_fn, verify=verify, digest=digest, rows=rows):
+                   (src_fn, dst_fn) for src_fn, dst_fn in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            src_fn, dst_fn = futures[future]
+            try:
+                yield src_fn, dst_fn, future.result(), None
+            except Exception as e:
+                yield src_fn, dst_fn, None, e
+
+
+def convert_dir(action: str, src: str, dst: str, *, verify: bool = False, recursive: bool = False, jobs: int = 1,
+                incremental: bool = False, export_path: str | None = None) -> int:
+    """Convert every file in a directory, returning the number of files that failed.
+
+    When unpacking with export_path, every file that is up to date afterwards is also exported
+    to one SQLite or Parquet file."""
+    src_ext, dst_ext = ('.btxt', '.txt') if action in ['u', 'unpack'] else ('.txt', '.btxt')
+    pattern = os.path.join(src, '**', '*' + src_ext) if recursive else os.path.join(src, '*' + src_ext)
+    os.makedirs(dst, exist_ok=True)
+    manifest = Manifest(os.path.join(dst, Manifest.FILENAME)) if incremental else None
+
+    tasks = []
+    source_hashes = {}
+    sources = glob.glob(pattern, recursive=recursive)
+    for src_fn in sources:
+        dst_fn = os.path.join(dst, os.path.relpath(src_fn, src).removesuffix(src_ext) + dst_ext)
+        if manifest is not None:
+            source_hashes[src_fn] = file_hash(src_fn)
+            if manifest.is_current(os.path.relpath(dst_fn, dst), source_hashes[src_fn], dst_fn, verify=verify):
+                continue
+        os.makedirs(os.path.dirname(dst_fn), exist_ok=True)
+        tasks.append((src_fn, dst_fn))
+
+    failed = 0
+    unpacking = action in ['u', 'unpack']
+    with export.open_exporter(export_path if unpacking else None) as exporter:
+        attempted = set()
+        try:
+            for src_fn, dst_fn, result, error in convert_all(action, tasks, verify=verify, digest=incremental,
+                                                             rows=exporter is not None, jobs=jobs):
+                if error is not None:
+                    failed += 1
+                    attempted.add(src_fn)
+                    print(f'{src_fn}: {type(error).__name__}: {error}', file=sys.stderr)
+                    if manifest is not None:
+                        manifest.discard(os.path.relpath(dst_fn, dst))
+                    continue
+                output_hash, rows = result if exporter is not None else (result, None)
+                if manifest is not None:
+                    manifest.update(os.path.relpath(dst_fn, dst), source_hashes[src_fn], output_hash, verified=verify)
+                print(dst_fn)
+                attempted.add(src_fn)
+                if exporter is not None:
+                    failed += export.write_file(exporter, 'btxt', EXPORT_COLUMNS, src_fn, rows, index=['label'])
+        finally:
+            if manifest is not None:
+                manifest.save()
+
+        if exporter is not None:
+            # the files skipped as up to date weren't read above, so they are read now
+            failed += export.write_files(exporter, 'btxt', EXPORT_COLUMNS, export_rows,
+                                         sorted(set(sources) - attempted), index=['label'], jobs=jobs)
+    if exporter is not None:
+        print(export_path)
+    return failed
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='btxt.py', description='Converts text from/to the BTXT format used in Touzoku to 1000-biki no Pokémon')
     parser.add_argument('action', choices=['p', 'pack', 'u', 'unpack'])
     parser.add_argument('src', help='source file or directory path')
     parser.add_argument('dst', help='destination file or directory path')
-    parser.add_argument('-v', help='verify', default=False)
+    parser.add_argument('-v', '--verify', help='verify', action='store_true')
+    parser.add_argument('-r', '--recursive', help='also convert files in subdirectories', action='store_true')
+    parser.add_argument('-j', '--jobs', help='number of files to convert in parallel (0 for one per CPU)', type=int, default=1)
+    parser.add_argument('-i', '--incremental', help='skip files that are unchanged since the last run', action='store_true')
+    parser.add_argument('-e', '--export', help='when unpacking, also write the rows to this .sqlite/.db or .parquet file')
     args = parser.parse_args()
 
-    if args.action in ['u', 'unpack']:
-        if os.path.isdir(args.src):
-            for src_fn in glob.glob(os.path.join(args.src, '*.btxt')):
-                dst_fn = os.path.join(args.dst, os.path.basename(src_fn).removesuffix('.btxt') + '.txt')
-                unpack(src_fn, dst_fn, verify=args.verify)
-                print(dst_fn)
-        else:
-            unpack(args.src, args.dst, verify=args.verify)
-    elif args.action in ['p', 'pack']:
-        if os.path.isdir(args.src):
-            for src_fn in glob.glob(os.path.join(args.src, '*.txt')):
-                dst_fn = os.path.join(args.dst, os.path.basename(src_fn).removesuffix('.txt') + '.btxt')
-                pack(src_fn, dst_fn)
-                print(dst_fn)
-        else:
-            pack(args.src, args.dst)
+    if args.export and args.action not in ['u', 'unpack']:
+        parser.error('only unpacked files can be exported')
+    if os.path.isdir(args.src):
+        if convert_dir(args.action, args.src, args.dst, verify=args.verify, recursive=args.recursive, jobs=args.jobs,
+                       incremental=args.incremental, export_path=args.export):
+            sys.exit(1)
+    else:
+        convert(args.action, args.src, args.dst, verify=args.verify)
+        if args.export:
+            if export.export_files(args.export, 'btxt', EXPORT_COLUMNS, export_rows, [args.src], index=['label']):
+                sys.exit(1)
+            print(args.export)
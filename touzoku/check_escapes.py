@@ -0,0 +1,85 @@
+# Checks that btxt.py escapes and unescapes dump text exactly like its original implementation.
+# Usage: python check_escapes.py [file.btxt ...] [-n count] [-s seed]
+
+import argparse
+import random
+import re
+import sys
+
+from btxt import BTXT
+
+
+def legacy_escape(s: str) -> str:
+    # btxt.py's original escape: four replace passes, then the control characters
+    s = (s.replace('\\', '\\\\')
+         .replace('\r', '\\r')
+         .replace('\n', '\\n')
+         .replace('\t', '\\t')
+         )
+    s = re.sub(f'[{BTXT.CONTROL}]', lambda match: f'\\x{ord(match.group(0)[0]):04X}', s)
+    return s
+
+
+def legacy_unescape(s: str) -> str:
+    # btxt.py's original unescape, one character at a time
+    out: list[str] = []
+    i = 0
+    while i < len(s):
+        c = s[i]; i += 1
+        if c != '\\':
+            out.append(c)
+        else:  # escape sequence
+            c = s[i]; i += 1
+            match c:
+                case 'r': out.append('\r')
+                case 'n': out.append('\n')
+                case 't': out.append('\t')
+                case 'x': out.append(chr(int(s[i:i+4], 16))); i += 4
+                case _: out.append(c)
+    return ''.join(out)
+
+
+def result(function, s: str):
+    # what a function returns, or just that it failed: the two raise different exceptions
+    # for a dangling backslash (IndexError before, ValueError now)
+    try:
+        return function(s)
+    except (IndexError, ValueError):
+        return Exception
+
+
+# the characters that matter to escaping, and some that don't
+ALPHABET = ['\\', '\r', '\n', '\t', 'x', 'r', 'n', 't', '0', '9', 'A', 'f', 'G', ' ', 'あ', '漢', '\U0001F600',
+            *BTXT.CONTROL]
+
+
+def check(strings, name: str) -> int:
+    """Compare both implementations on every string, returning the number of mismatches."""
+    failed = 0
+    for s in strings:
+        escaped = BTXT.escape(s)
+        checks = [('escape', escaped, legacy_escape(s)),
+                  ('round trip', BTXT.unescape(escaped), s),
+                  ('unescape', result(BTXT.unescape, s), result(legacy_unescape, s))]
+        for what, a, b in checks:
+            if a != b:
+                failed += 1
+                print(f'{name}: {what} differs for {s!r}: {a!r} != {b!r}', file=sys.stderr)
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks btxt.py escapes and unescapes dump text like its original implementation')
+    parser.add_argument('files', nargs='*', help='BTXT files whose strings are checked too')
+    parser.add_argument('-n', '--count', help='number of random strings to check', type=int, default=100000)
+    parser.add_argument('-s', '--seed', help='random seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    failed = check((''.join(rng.choices(ALPHABET, k=rng.randrange(12))) for _ in range(args.count)), 'random')
+    for path in args.files:
+        with open(path, 'rb') as f:
+            failed += check(BTXT.read(f).text, path)
+    print('OK' if not failed else f'{failed} differences')
+    if failed:
+        sys.exit(1)
@@ -1,6 +1,18 @@
 import argparse
+import array
+import concurrent.futures
+import contextlib
+import functools
+import glob
+import mmap
+import os
+import re
 import struct
-from typing import BinaryIO, TextIO, Self
+import sys
+from typing import BinaryIO, Iterable, Sequence, TextIO, Self
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import export, tables
 
 
 class MSG:
@@ -21,12 +33,7 @@ class MSG:
     @classmethod
     def read(cls, f: BinaryIO) -> Self:
         h_00, language, h_04, length, h_0c = struct.unpack(cls.HEADER_FORMAT, f.read(struct.calcsize(cls.HEADER_FORMAT)))
-        if h_00 != cls.HEADER_00 or h_04 != cls.HEADER_04 or h_0c != cls.HEADER_0C:
-            if h_00[0] == 0x10:
-                raise ValueError('Expected a MSG file, not an LZ-compressed file. Decompress and extract the archive first.')
-            if h_00 + language == b'NARC':
-                raise ValueError('Expected a MSG file, not a NARC file. Extract the archive first.')
-            raise ValueError('invalid header')
+        cls.check_header(h_00, language, h_04, h_0c)
 
         tbl_magic, tbl_size = struct.unpack(cls.BLOCK_HEADER, f.read(struct.calcsize(cls.BLOCK_HEADER)))
         if tbl_magic != cls.BLOCK_MAGIC_TBL:
@@ -40,6 +47,59 @@ class MSG:
 
         return cls(tbl, dat, language=language, length=length)
 
+    @classmethod
+    def from_buffer(cls, data) -> Self:
+        """Parse the data from a bytes-like object, keeping the blocks as views into it instead of copying them."""
+        view = memoryview(data)
+        h_00, language, h_04, length, h_0c = struct.unpack_from(cls.HEADER_FORMAT, view)
+        cls.check_header(h_00, language, h_04, h_0c)
+        pos = struct.calcsize(cls.HEADER_FORMAT)
+
+        tbl_magic, tbl_size = struct.unpack_from(cls.BLOCK_HEADER, view, pos)
+        if tbl_magic != cls.BLOCK_MAGIC_TBL:
+            raise ValueError('unrecognized block (expected MTBL)')
+        pos += struct.calcsize(cls.BLOCK_HEADER)
+        tbl = view[pos:pos + tbl_size]
+        pos += tbl_size
+
+        dat_magic, dat_size = struct.unpack_from(cls.BLOCK_HEADER, view, pos)
+        if dat_magic != cls.BLOCK_MAGIC_DAT:
+            raise ValueError('unrecognized chunk (expected MDAT)')
+        pos += struct.calcsize(cls.BLOCK_HEADER)
+        dat = view[pos:pos + dat_size]
+
+        return cls(tbl, dat, language=language, length=length)
+
+    @classmethod
+    def check_header(cls, h_00: bytes, language: bytes, h_04: bytes, h_0c: bytes):
+        if h_00 != cls.HEADER_00 or h_04 != cls.HEADER_04 or h_0c != cls.HEADER_0C:
+            if h_00[0] == 0x10:
+                raise ValueError('Expected a MSG file, not an LZ-compressed file. Decompress and extract the archive first.')
+            if h_00 + language == b'NARC':
+                raise ValueError('Expected a MSG file, not a NARC file. Extract the archive first.')
+            raise ValueError('invalid header')
+
+    @classmethod
+    def pack(cls, strings: Iterable[bytes], *, language: bytes = b'U') -> Self:
+        """Build a MSG from encoded strings, storing identical strings once and pointing every entry for them at it."""
+        offsets: list[int] = []
+        seen: dict[bytes, int] = {}
+        chunks: list[bytes] = []
+        size = 0
+        for data in strings:
+            offset = seen.get(data)
+            if offset is None:
+                length = len(data) // 2
+                if length > 0xFFFF:
+                    raise ValueError(f'string {len(offsets)} is too long ({length} characters)')
+                # u16 length, the code units, then padding so the next string stays 4-byte aligned
+                chunk = struct.pack('<H', length) + data + bytes(-(2 + len(data)) % 4)
+                offset = seen[data] = size
+                chunks.append(chunk)
+                size += len(chunk)
+            offsets.append(offset // 4)
+        return cls(struct.pack(f'<{len(offsets)}I', *offsets), b''.join(chunks), language=language)
+
     def write(self, f: BinaryIO):
         length = self.length if self.length > 0 else sum([struct.calcsize(self.HEADER_FORMAT),
                                                           struct.calcsize(self.BLOCK_HEADER) * 2,
@@ -50,12 +110,50 @@ class MSG:
         f.write(struct.pack(self.BLOCK_HEADER, self.BLOCK_MAGIC_DAT, len(self.dat)))
         f.write(self.dat)
 
-    def get(self, index: int, table: dict[int, str]):
+    def get(self, index: int, table: dict[int, str] | Sequence[str]):
+        """Decode a string, given a table from `load_table` or, much faster, from `dense_table`."""
         offset: int = struct.unpack_from(f'<I', self.tbl, 4 * index)[0] * 4
         if offset >= len(self.dat):
             return None
-        length = self.read_u16(offset)
-        return ''.join(self.read_char(i, table) for i in range(offset + 2, offset + 2 + length * 2, 2))
+        text = self.read_codes(offset + 2, offset + 2 + self.read_u16(offset) * 2)
+        if isinstance(table, dict):
+            return ''.join([table.get(value, f'\\x{value:04X}') for value in map(ord, text)])
+        return text.translate(table)
+
+    def iter_strings(self, table: dict[int, str] | Sequence[str]):
+        """Decode every string in order, unpacking MDAT once rather than once per string."""
+        if isinstance(table, dict):
+            table = dense_table(table)
+        for run in self.iter_runs():
+            yield None if run is None else run.translate(table)
+
+    def iter_runs(self):
+        """Yield each string's raw code units (as from `read_codes`), or None for entries past the end of MDAT."""
+        text = self.read_codes(0, len(self.dat) & ~1)
+        for offset, in struct.iter_unpack('<I', self.tbl[:len(self.tbl) & ~3]):
+            if offset * 4 >= len(self.dat):
+                yield None
+                continue
+            start = offset * 2 + 1
+            end = start + ord(text[start - 1])
+            if end > len(text):
+                raise IndexError('string runs past the end of MDAT')
+            yield text[start:end]
+
+    def read_codes(self, start: int, end: int) -> str:
+        # Every u16 becomes the code point with the same value, so a whole run is unpacked in one
+        # step and str.translate can map it through a dense table. Decoding as UTF-16 does that
+        # until a high surrogate is followed by a low one, which it joins into one character; then
+        # the u16s are widened to u32s first, which UTF-32 decodes one to one.
+        if end > len(self.dat):
+            raise IndexError('string runs past the end of MDAT')
+        text = str(self.dat[start:end], 'utf-16-le', 'surrogatepass')
+        if len(text) * 2 == end - start:
+            return text
+        codes = array.array('H', self.dat[start:end])
+        if sys.byteorder == 'big':
+            codes.byteswap()
+        return str(array.array('I', codes), 'utf-32-le' if sys.byteorder == 'little' else 'utf-32-be', 'surrogatepass')
 
     def read_u16(self, offset: int):
         return self.dat[offset] + (self.dat[offset + 1] << 8)
@@ -64,35 +162,275 @@ class MSG:
         value = self.read_u16(offset)
         return table.get(value, f'\\x{value:04X}')
 
-    def dump(self, f: TextIO, table: dict[int, str]):
-        for index in range(len(self.tbl) // 4):
-            s = self.get(index, table)
-            if s is not None:
-                f.write(s)
-                f.write('\n')
+    def dump(self, f: TextIO, table: dict[int, str] | Sequence[str]):
+        f.writelines(s + '\n' for s in self.iter_strings(table) if s is not None)
 
 
-def load_table(region: str):
-    table: dict[int, str] = {}
-    with open(f'table_{region}.tbl', 'r', encoding='utf-8') as tbl_file:
-        for line in tbl_file.read().splitlines(keepends=False):
-            code, char = line.split('=', 1)
-            table[int(code, 16)] = char
-    return table
+
+class Encoder:
+    """Encodes text back into Trozei code units through a reversed character table."""
+    ESCAPE = r'\\x[0-9A-Fa-f]{4}'
+
+    def __init__(self, table: dict[int, str]):
+        reverse: dict[str, str] = {}
+        for code, char in table.items():
+            if char:
+                reverse.setdefault(char, chr(code))
+        # \xNNNN escapes and multi-character entries are split out longest first,
+        # and everything between them is single characters for str.translate.
+        self.multi = {char: code for char, code in reverse.items() if len(char) > 1}
+        self.pattern = re.compile('(' + '|'.join([self.ESCAPE] + [re.escape(char) for char in
+                                                  sorted(self.multi, key=len, reverse=True)]) + ')')
+        singles = {ord(char): code for char, code in reverse.items() if len(char) == 1}
+        self.table: list[str | None] = [None] * (max(singles, default=-1) + 1)
+        for char, code in singles.items():
+            self.table[char] = code
+
+    def encode(self, s: str) -> bytes:
+        """Encode a string into little-endian u16 code units."""
+        parts = self.pattern.split(s)
+        for i in range(0, len(parts), 2):
+            part = parts[i]
+            # Characters the table lacks are deleted by translate (or are past its end)
+            encoded = part.translate(self.table)
+            if len(encoded) != len(part) or (part and ord(max(part)) >= len(self.table)):
+                char = next(c for c in part if ord(c) >= len(self.table) or self.table[ord(c)] is None)
+                raise ValueError(f'{char!r} is not in the character table')
+            parts[i] = encoded
+        for i in range(1, len(parts), 2):
+            parts[i] = self.multi.get(parts[i]) or chr(int(parts[i][2:], 16))
+        return ''.join(parts).encode('utf-16-le', 'surrogatepass')
+
+
+class LazyMSG:
+    """Read-only view of a MSG file that only decodes the strings that are accessed."""
+
+    def __init__(self, data, table: dict[int, str] | Sequence[str], *, cache_size: int = 256):
+        self._data = data
+        self.msg = MSG.from_buffer(data)
+        self.table = dense_table(table) if isinstance(table, dict) else table
+        self.get = functools.lru_cache(maxsize=cache_size)(self._get)
+
+    @classmethod
+    def open(cls, path: str, table: dict[int, str] | Sequence[str], **kwargs) -> Self:
+        """Map a MSG file into memory and open it for random access."""
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(b'', table, **kwargs)
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(data, table, **kwargs)
+        except BaseException:
+            data.close()
+            raise
+
+    def close(self):
+        """Release the underlying buffer, closing it if it was mapped by `open`."""
+        self.get.cache_clear()
+        self.msg.tbl.release()
+        self.msg.dat.release()
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.msg.tbl) // 4
+
+    def __getitem__(self, index: int) -> str | None:
+        return self.get(range(len(self))[index])
+
+    def _get(self, index: int) -> str | None:
+        return self.msg.get(index, self.table)
+
+
+REGIONS = ['jp', 'us', 'eu', 'kr']
+EXPORT_COLUMNS = [('region', str), ('index', int), ('text', str)]
+
+
+@functools.cache
+def load_table(region: str) -> dict[int, str]:
+    """Load a region's character table, from the working directory or else next to this script."""
+    path = f'table_{region}.tbl'
+    if not os.path.exists(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    return tables.load(path)
+
+
+@functools.cache
+def fallback_table() -> tuple[str, ...]:
+    return tuple(f'\\x{value:04X}' for value in range(0x10000))
+
+
+def dense_table(table: dict[int, str]) -> list[str]:
+    """Expand a table into a list indexed by every possible code, with `\\xNNNN` for unknown ones."""
+    dense = list(fallback_table())
+    for code, char in table.items():
+        if 0 <= code < len(dense):
+            dense[code] = char
+    return dense
+
+
+@functools.cache
+def load_dense_table(region: str) -> list[str]:
+    return dense_table(load_table(region))
+
+
+def region_path(dst: str, region: str) -> str:
+    root, ext = os.path.splitext(dst)
+    return f'{root}.{region}{ext}'
 
 
 def dump_msg(src: str, dst: str, region: str = 'us'):
-    table = load_table(region)
+    dump_regions(src, dst, [region])
+
+
+def dump_regions(src: str, dst: str, regions: list[str], *, tsv: bool = False, rows: bool = False):
+    """Dump a MSG file with several region tables, reading and unpacking it only once.
+
+    Writes one TSV with a column per region, or one text file per region (named
+    `name.region.txt` when there is more than one). Returns the paths written, and with
+    rows, the (region, index, text) rows for common.export from the same read."""
+    with open(src, 'rb') as f:
+        msg = MSG.read(f)
+    runs = list(msg.iter_runs())
+    indexes = [index for index, run in enumerate(runs) if run is not None]
+    texts = [[runs[index].translate(table) for index in indexes] for table in map(load_dense_table, regions)]
+
+    if tsv:
+        with open(dst, 'w', encoding='utf-8') as out:
+            out.write('\t'.join(['index', *regions]) + '\n')
+            out.writelines('\t'.join([str(index), *row]) + '\n' for index, *row in zip(indexes, *texts))
+        paths = [dst]
+    else:
+        paths = [region_path(dst, region) for region in regions] if len(regions) > 1 else [dst]
+        with contextlib.ExitStack() as stack:
+            for path, region_texts in zip(paths, texts):
+                out = stack.enter_context(open(path, 'w', encoding='utf-8'))
+                out.writelines(text + '\n' for text in region_texts)
+    if rows:
+        return paths, [(region, index, text) for region, region_texts in zip(regions, texts)
+                       for index, text in zip(indexes, region_texts)]
+    return paths
+
+
+def export_rows(src: str, regions: list[str]) -> list[tuple[str, int, str]]:
+    """(region, index, text) rows for common.export, with each region's table."""
     with open(src, 'rb') as f:
         msg = MSG.read(f)
-    with open(dst, 'w', encoding='utf-8') as out:
-        msg.dump(out, table)
+    runs = list(msg.iter_runs())
+    return [(region, index, run.translate(load_dense_table(region)))
+            for region in regions for index, run in enumerate(runs) if run is not None]
+
+
+def dump_all(tasks: list[tuple[str, str]], regions: list[str], *, tsv: bool = False, rows: bool = False, jobs: int = 1):
+    """Dump each (src, dst) pair, yielding (src, what dump_regions returned, exception) as each file finishes."""
+    if jobs == 1:
+        for src_fn, dst_fn in tasks:
+            try:
+                yield src_fn, dump_regions(src_fn, dst_fn, regions, tsv=tsv, rows=rows), None
+            except Exception as e:
+                yield src_fn, None, e
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs or None) as executor:
+        futures = {executor.submit(dump_regions, src_fn, dst_fn, regions, tsv=tsv, rows=rows): src_fn
+                   for src_fn, dst_fn in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            src_fn = futures[future]
+            try:
+                yield src_fn, future.result(), None
+            except Exception as e:
+                yield src_fn, None, e
+
+
+def is_msg(path: str) -> bool:
+    """Check a file starts like a MSG file: its header, then the MTBL block."""
+    with open(path, 'rb') as f:
+        head = f.read(struct.calcsize(MSG.HEADER_FORMAT) + 4)
+    return (head[:3] == MSG.HEADER_00 and head[4:8] == MSG.HEADER_04
+            and head[struct.calcsize(MSG.HEADER_FORMAT):] == MSG.BLOCK_MAGIC_TBL)
+
+
+def dump_dir(src: str, dst: str, regions: list[str], *, tsv: bool = False, recursive: bool = False,
+             jobs: int = 1, export_path: str | None = None) -> int:
+    """Dump every MSG file in a directory, returning the number of files that failed.
+
+    Other files are skipped.
+    With export_path, the files that dumped are also exported to one SQLite or Parquet file."""
+    pattern = os.path.join(src, '**', '*') if recursive else os.path.join(src, '*')
+    dst_ext = '.tsv' if tsv else '.txt'
+    os.makedirs(dst, exist_ok=True)
+
+    tasks = []
+    for src_fn in glob.glob(pattern, recursive=recursive):
+        if not os.path.isfile(src_fn) or not is_msg(src_fn):
+            continue
+        dst_fn = os.path.join(dst, os.path.relpath(src_fn, src) + dst_ext)
+        os.makedirs(os.path.dirname(dst_fn), exist_ok=True)
+        tasks.append((src_fn, dst_fn))
+
+    failed = 0
+    with export.open_exporter(export_path) as exporter:
+        for src_fn, result, error in dump_all(tasks, regions, tsv=tsv, rows=exporter is not None, jobs=jobs):
+            if error is not None:
+                failed += 1
+                print(f'{src_fn}: {type(error).__name__}: {error}', file=sys.stderr)
+                continue
+            paths, rows = result if exporter is not None else (result, None)
+            for path in paths:
+                print(path)
+            if exporter is not None:
+                failed += export.write_file(exporter, 'trozei', EXPORT_COLUMNS, src_fn, rows, index=['index'])
+    if export_path:
+        print(export_path)
+    return failed
+
+
+def pack_msg(src: str, dst: str, region: str = 'us', language: bytes = b'U'):
+    encoder = Encoder(load_table(region))
+    with open(src, 'r', encoding='utf-8') as f:
+        lines = f.read().split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    msg = MSG.pack(map(encoder.encode, lines), language=language)
+    with open(dst, 'wb') as out:
+        msg.write(out)
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(prog='trozei.py', description='Dumps text from Pokémon Trozei')
+    parser = argparse.ArgumentParser(prog='trozei.py', description='Dumps text from Pokémon Trozei, or packs it back')
     parser.add_argument('src', help='source path')
     parser.add_argument('dst', help='destination path')
-    parser.add_argument('-r', '--region', help='which region table to use',choices=['jp', 'us', 'eu', 'kr'], default='us')
+    parser.add_argument('-r', '--region', help='which region table to use (all dumps with every table)',
+                        choices=[*REGIONS, 'all'], default='us')
+    parser.add_argument('-p', '--pack', help='pack a text file (one string per line) into a MSG file', action='store_true')
+    parser.add_argument('-l', '--language', help='language byte for the MSG header when packing', default='U')
+    parser.add_argument('-t', '--tsv', help='dump to one TSV with a column per region', action='store_true')
+    parser.add_argument('--recursive', help='also dump files in subdirectories', action='store_true')
+    parser.add_argument('-j', '--jobs', help='number of files to dump in parallel (0 for one per CPU)', type=int, default=1)
+    parser.add_argument('-e', '--export', help='also write the rows to this .sqlite/.db or .parquet file')
     args = parser.parse_args()
-    dump_msg(args.src, args.dst, args.region)
+
+    if args.pack and args.region == 'all':
+        parser.error('packing needs a single region')
+    if args.pack and args.export:
+        parser.error('only dumps can be exported')
+    regions = REGIONS if args.region == 'all' else [args.region]
+    if args.pack:
+        pack_msg(args.src, args.dst, args.region, args.language.encode('ascii'))
+    elif os.path.isdir(args.src):
+        if dump_dir(args.src, args.dst, regions, tsv=args.tsv, recursive=args.recursive, jobs=args.jobs,
+                    export_path=args.export):
+            sys.exit(1)
+    else:
+        dump_regions(args.src, args.dst, regions, tsv=args.tsv)
+        if args.export:
+            if export.export_files(args.export, 'trozei', EXPORT_COLUMNS,
+                                   functools.partial(export_rows, regions=regions), [args.src], index=['index']):
+                sys.exit(1)
+            print(args.export)
@@ -1,40 +1,197 @@
 # Parses GMSG/GSMG files and outputs a txt file.
-# Usage: python gmsg.py <filename>
+# Usage: python gmsg.py <filename> [output file] [-e export.sqlite|export.parquet]
+#        python gmsg.py <directory> <output directory> [-j jobs] [-e export.sqlite|export.parquet]
 
+import argparse
+import codecs
+import concurrent.futures
+import glob
+import mmap
+import os
+import struct
 import sys
 
-def read_val(data, index, length=4):
-    # print(data[index:index+length])
-    return int.from_bytes(data[index:index+length], byteorder='little', signed=False)
-
-with open(sys.argv[1], 'rb') as file:
-    data = file.read()
-    
-    # Check file header
-    if (data[:4] != b'GMSG'):
-        print('Not a GMSG file.')
-        sys.exit()
-        
-    total_size, start_id, end_id, c, d, e, start_pointer = [read_val(data, i) for i in range(0x04, 0x20, 4)]
-    print((total_size, start_id, end_id, c, d, e, start_pointer), [hex(i) for i in (total_size, start_id, end_id, c, d, e, start_pointer)])
-    
-    count = end_id - start_id + 1
-    print(count)
-    
-    pointers = [read_val(data, i) + start_pointer for i in range(0x20, 0x20 + 4 * count, 4)] + [total_size]
-    #for i in range(1, len(pointers) - 1):
-    #    pointers[i] += start_pointer
-    print([hex(i) for i in pointers])
-    
-    output = ''
-    for i in range(count):
-        id = start_id + i
-        string = data[pointers[i]:pointers[i+1]].decode('utf-16-le')
-        string = string[0:string.find('\x00')]
-        string = string.replace('\\', '\\\\').replace('\r', '\\r').replace('\n', '\\n').replace('\t', '\\t')
-        for i in range(0x00, 0x20):
-            string = string.replace(chr(i), '\\x' + hex(i)[2:].zfill(2))
-        output += '\t'.join([str(id), string]) + '\n'
-        
-    with open((sys.argv[1])[:-7] + '.txt', 'w', encoding='utf-8') as out:
-        out.write(output)
\ No newline at end of file
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import export
+
+EXPORT_COLUMNS = [('id', int), ('text', str)]
+
+
+class GMSG:
+    MAGIC = b'GMSG'
+    # total size, first and last ID, three unknown values, start of the string data
+    HEADER_FORMAT = '<7I'
+    HEADER_OFFSET = 0x04
+    POINTER_OFFSET = 0x20
+    # backslash and the usual whitespace escapes, then \xNN for any other control character;
+    # nulls are left alone since a string is cut at its first one
+    ESCAPES = str.maketrans({'\\': '\\\\', '\r': '\\r', '\n': '\\n', '\t': '\\t',
+                             **{chr(i): f'\\x{i:02x}' for i in range(0x01, 0x20) if chr(i) not in '\r\n\t'}})
+
+    def __init__(self, data):
+        self.data = data
+        self.view = memoryview(data)
+        if self.view[:4] != self.MAGIC:
+            raise ValueError('Not a GMSG file.')
+        (self.total_size, self.start_id, self.end_id, self.c, self.d, self.e,
+         self.start_pointer) = struct.unpack_from(self.HEADER_FORMAT, self.view, self.HEADER_OFFSET)
+        count = len(self)
+        pointers = struct.unpack_from(f'<{count}I', self.view, self.POINTER_OFFSET)
+        self.pointers = [pointer + self.start_pointer for pointer in pointers] + [self.total_size]
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return cls(b'')
+            return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def close(self):
+        self.view.release()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return max(self.end_id - self.start_id + 1, 0)
+
+    def __getitem__(self, id):
+        # strings are looked up by message ID, not by position
+        if not self.start_id <= id <= self.end_id:
+            raise KeyError(id)
+        i = id - self.start_id
+        return self.read(self.pointers[i], self.pointers[i + 1])
+
+    def read(self, start, end):
+        # strings are null-terminated utf-16le; without a terminator the last character is dropped
+        with self.view[start:end] as raw:
+            string = codecs.utf_16_le_decode(raw, 'strict', True)[0]
+        return string[0:string.find('\x00')]
+
+    def __iter__(self):
+        # (ID, string) for every message
+        return zip(range(self.start_id, self.end_id + 1), self.strings())
+
+    def strings(self):
+        # Decodes the whole string area in one go when every string lines up with it, which it
+        # does unless the pointers are odd or a surrogate pair spans two strings.
+        pointers = [min(pointer, len(self.view)) for pointer in self.pointers]
+        base = min(pointers)
+        try:
+            with self.view[base:max(pointers)] as raw:
+                text = codecs.utf_16_le_decode(raw, 'strict', True)[0]
+        except UnicodeDecodeError:
+            text = None
+        if (text is None or len(text) * 2 != max(pointers) - base
+                or any((pointer - base) % 2 for pointer in pointers)):
+            return [self.read(start, end) for start, end in zip(self.pointers, self.pointers[1:])]
+
+        strings = []
+        for start, end in zip(pointers, pointers[1:]):
+            start, end = (start - base) // 2, (end - base) // 2
+            strings.append(text[start:end] if start < end else '')
+        return [string[0:string.find('\x00')] for string in strings]
+
+    @classmethod
+    def escape(cls, string):
+        return string.translate(cls.ESCAPES)
+
+    def dump(self, f, strings=None):
+        # Strings never contain a null once cut at their terminator, so they are escaped
+        # all together in one translate, with nulls (left alone by the table) between them.
+        # strings can be passed in when they were already decoded.
+        if strings is None:
+            strings = self.strings()
+        escaped = '\x00'.join(strings).translate(self.ESCAPES).split('\x00')
+        f.writelines(f'{id}\t{string}\n' for id, string in zip(range(self.start_id, self.end_id + 1), escaped))
+
+
+def dump(src, dst=None, verbose=False, rows=False):
+    # dst defaults to the GMSG name; inside a directory it keeps the file's own name.
+    # With rows, the (ID, string) rows for common.export are returned too, from the same read.
+    with GMSG.open(src) as gmsg:
+        if verbose:
+            header = (gmsg.total_size, gmsg.start_id, gmsg.end_id, gmsg.c, gmsg.d, gmsg.e, gmsg.start_pointer)
+            print(header, [hex(i) for i in header])
+            print(len(gmsg))
+        if dst is None:
+            dst = src[:-7] + '.txt'
+        elif os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.splitext(os.path.basename(src))[0] + '.txt')
+        strings = gmsg.strings()
+        with open(dst, 'w', encoding='utf-8') as out:
+            gmsg.dump(out, strings)
+        if rows:
+            return dst, list(zip(range(gmsg.start_id, gmsg.end_id + 1), strings))
+    return dst
+
+
+def export_rows(src):
+    # (ID, string) rows, unescaped, for common.export
+    with GMSG.open(src) as gmsg:
+        return list(gmsg)
+
+
+def is_gmsg(path):
+    with open(path, 'rb') as f:
+        return f.read(4) == GMSG.MAGIC
+
+
+def dump_dir(src, dst, jobs=0, export_path=None):
+    # Dumps every GMSG in a directory across a process pool, and optionally exports the ones
+    # that dumped to one SQLite or Parquet file. Returns the number of files that failed.
+    os.makedirs(dst, exist_ok=True)
+    sources = [src_fn for src_fn in sorted(glob.glob(os.path.join(src, '*')))
+               if os.path.isfile(src_fn) and is_gmsg(src_fn)]
+    failed = 0
+    with export.open_exporter(export_path) as exporter, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=jobs or None) as executor:
+        futures = {executor.submit(dump, src_fn, dst, rows=exporter is not None): src_fn for src_fn in sources}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                print(f'{futures[future]}: {type(e).__name__}: {e}', file=sys.stderr)
+                continue
+            if exporter is None:
+                print(result)
+                continue
+            dst_fn, rows = result
+            print(dst_fn)
+            failed += export.write_file(exporter, 'gmsg', EXPORT_COLUMNS, futures[future], rows, index=['id'])
+    if export_path:
+        print(export_path)
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parses GMSG/GSMG files and outputs a txt file.')
+    parser.add_argument('src', help='GMSG file, or a directory of them')
+    parser.add_argument('dst', nargs='?', help='Output file or directory')
+    parser.add_argument('-j', '--jobs', help='number of files to dump in parallel (0 for one per CPU)', type=int, default=0)
+    parser.add_argument('-e', '--export', help='also write the rows to this .sqlite/.db or .parquet file')
+    args = parser.parse_args()
+
+    try:
+        if os.path.isdir(args.src):
+            if args.dst is None:
+                parser.error('a directory needs an output directory')
+            if dump_dir(args.src, args.dst, args.jobs, args.export):
+                sys.exit(1)
+        else:
+            dump(args.src, args.dst, verbose=True)
+            if args.export:
+                if export.export_files(args.export, 'gmsg', EXPORT_COLUMNS, export_rows, [args.src], index=['id']):
+                    sys.exit(1)
+                print(args.export)
+    except UnicodeDecodeError:
+        raise
+    except ValueError as e:
+        print(e)
+        sys.exit(1)